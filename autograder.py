@@ -118,6 +118,27 @@ to follow your instructor's guidelines to receive credit on your project.
 
 TESTS = []
 PREREQS = {}
+CHECKS = []
+
+def check(fn):
+    """Registers an ungraded check of an optional feature, run by --checks"""
+    CHECKS.append(fn)
+    return fn
+
+def run_checks():
+    """Runs every ungraded check, returning the number that failed"""
+    failures = 0
+    for fn in CHECKS:
+        print("*** {}".format(fn.__name__))
+        try:
+            fn()
+            print("*** PASS: {}".format(fn.__name__))
+        except:
+            failures += 1
+            print(traceback.format_exc())
+            print("*** FAIL: {}".format(fn.__name__))
+    print("\n{} of {} checks passed".format(len(CHECKS) - failures, len(CHECKS)))
+    return failures
 def add_prereq(q, pre):
     if isinstance(pre, str):
         pre = [pre]
@@ -140,6 +161,7 @@ def parse_options(argv):
         no_graphics=False,
         mute_output=False,
         check_dependencies=False,
+        checks=False,
         )
     parser.add_option('--edx-output',
                         dest = 'edx_output',
@@ -165,6 +187,10 @@ def parse_options(argv):
                         dest = 'check_dependencies',
                         action = 'store_true',
                         help = 'check that numpy and matplotlib are installed')
+    parser.add_option('--checks',
+                        dest = 'checks',
+                        action = 'store_true',
+                        help = 'Run the ungraded checks of optional features (e.g. model replicas) instead of grading')
     (options, args) = parser.parse_args(argv)
     return options
 
@@ -177,6 +203,10 @@ def main():
     if options.no_graphics:
         disable_graphics()
 
+    if options.checks:
+        with no_graphics():
+            sys.exit(1 if run_checks() else 0)
+
     questions = set()
     maxes = {}
     for q, points, fn in TESTS:
@@ -224,7 +254,6 @@ def main():
 ################################################################################
 
 import numpy as np
-import matplotlib
 import contextlib
 
 def check_dependencies():
@@ -658,10 +687,11 @@ def check_regression(tracker):
     model = models.RegressionModel()
     assert model.get_data_and_monitor == backend.get_data_and_monitor_regression, "RegressionModel.get_data_and_monitor is not set correctly"
     assert model.learning_rate > 0, "RegressionModel.learning_rate is not set correctly"
-    model.train()
+    loss_threshold = 0.02
+    model.train(stop_criterion=backend.StopCriterion(
+        'loss', target=loss_threshold, mode='min'))
 
     stats = backend.get_stats(model)
-    loss_threshold = 0.02
     if stats['loss'] <= loss_threshold:
         tracker.add_points(2)
     else:
@@ -695,7 +725,8 @@ def check_odd_regression(tracker):
         print("Your OddRegressionModel does not satisfy f(0) = 0")
         return
 
-    model.train()
+    model.train(stop_criterion=backend.StopCriterion(
+        'loss', target=loss_threshold, mode='min'))
 
     stats = backend.get_stats(model)
     full_points = True
@@ -722,40 +753,80 @@ def check_digit_classification(tracker):
     model = models.DigitClassificationModel()
     assert model.get_data_and_monitor == backend.get_data_and_monitor_digit_classification, "DigitClassificationModel.get_data_and_monitor is not set correctly"
     assert model.learning_rate > 0, "DigitClassificationModel.learning_rate is not set correctly"
-    model.train()
+    accuracy_threshold = 0.97
+    model.train(stop_criterion=backend.StopCriterion(
+        'dev_accuracy', target=accuracy_threshold, mode='max'))
 
     stats = backend.get_stats(model)
-    accuracy_threshold = 0.97
     if stats['dev_accuracy'] >= accuracy_threshold:
         tracker.add_points(1)
     else:
         print("Your final validation accuracy ({:%}) must be at least {:.0%} to receive points for this question".format(stats['dev_accuracy'], accuracy_threshold))
 
+def run_rl_trial(seed, in_worker=True):
+    """
+    Trains one DeepQModel with the given seed, returning its final stats.
+
+    When run in a worker process, graphics and the trial's own output are
+    disabled so that parallel trials do not interleave.
+    """
+    import models, backend
+    if in_worker:
+        backend.use_graphics = False
+        sys.stdout = WritableNull()
+
+    np.random.seed(seed)
+    random.seed(seed)
+    model = models.DeepQModel()
+    model.train()
+    return backend.get_stats(model)
+
 add_prereq('q7', ['q2', 'q3'])
 @test('q7', points=1)
 def check_rl(tracker):
     import models, backend
+    import multiprocessing
+
+    model = models.DeepQModel()
+    assert model.get_data_and_monitor == backend.get_data_and_monitor_rl, "DeepQModel.get_data_and_monitor is not set correctly"
+    assert model.learning_rate > 0, "DeepQModel.learning_rate is not set correctly"
 
     num_trials = 6
     trials_satisfied = 0
     trials_satisfied_required = 3
-    for trial_number in range(num_trials):
-        model = models.DeepQModel()
-        assert model.get_data_and_monitor == backend.get_data_and_monitor_rl, "DeepQModel.get_data_and_monitor is not set correctly"
-        assert model.learning_rate > 0, "DeepQModel.learning_rate is not set correctly"
-        model.train()
-
-        stats = backend.get_stats(model)
-        if stats['mean_reward'] >= stats['reward_threshold']:
-            trials_satisfied += 1
-
-        if trials_satisfied >= trials_satisfied_required:
-            tracker.add_points(1)
-            return
-        else:
-            trials_left = num_trials - (trial_number + 1)
-            if trials_satisfied + trials_left < trials_satisfied_required:
-                break
+    seeds = list(range(num_trials))
+    processes = min(num_trials, multiprocessing.cpu_count())
+
+    # Trials are independent, so run them on every core and stop as soon as
+    # the outcome is decided. The outcome does not depend on the order in
+    # which trials finish.
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(run_rl_trial, seeds)
+    else:
+        pool = None
+        results = (run_rl_trial(seed, in_worker=False) for seed in seeds)
+
+    try:
+        for trial_number, stats in enumerate(results):
+            if pool is not None:
+                print("Trial {}/{} finished with mean reward {:.1f}".format(
+                    trial_number + 1, num_trials, stats['mean_reward']))
+            if stats['mean_reward'] >= stats['reward_threshold']:
+                trials_satisfied += 1
+
+            if trials_satisfied >= trials_satisfied_required:
+                tracker.add_points(1)
+                return
+            else:
+                trials_left = num_trials - (trial_number + 1)
+                if trials_satisfied + trials_left < trials_satisfied_required:
+                    break
+    finally:
+        if pool is not None:
+            # Cancel any trials that are still running
+            pool.terminate()
+            pool.join()
 
     print("To receive credit for this question, your agent must receive a mean reward of at least {} on {} out of {} trials".format(
         stats['reward_threshold'], trials_satisfied_required, num_trials))
@@ -767,15 +838,106 @@ def check_lang_id(tracker):
     model = models.LanguageIDModel()
     assert model.get_data_and_monitor == backend.get_data_and_monitor_lang_id, "LanguageIDModel.get_data_and_monitor is not set correctly"
     assert model.learning_rate > 0, "LanguageIDModel.learning_rate is not set correctly"
-    model.train()
+    accuracy_threshold = 0.81
+    model.train(stop_criterion=backend.StopCriterion(
+        'dev_accuracy', target=accuracy_threshold, mode='max'))
 
     stats = backend.get_stats(model)
-    accuracy_threshold = 0.81
     if stats['dev_accuracy'] >= accuracy_threshold:
         tracker.add_points(2)
     else:
         print("Your final validation accuracy ({:%}) must be at least {:.0%} to receive points for this question".format(stats['dev_accuracy'], accuracy_threshold))
 
 
+################################################################################
+# Ungraded checks of optional features begin here
+################################################################################
+
+def assert_replica_gradients(model, x, y):
+    """
+    Asserts that a model stacked with `stack_replicas` computes, for every
+    replica, the same gradients as the unstacked model does.
+    """
+    import copy
+    stacked = copy.deepcopy(model)
+    stacked.stack_replicas(2)
+    for replicas, variable in zip(stacked.get_variables(), model.get_variables()):
+        replicas.data[...] = variable.data
+
+    graph = model.run(x, y)
+    graph.backprop()
+    stacked_graph = stacked.run(x, y)
+    stacked_graph.backprop()
+    for replicas, variable in zip(stacked.get_variables(), model.get_variables()):
+        expected = graph.get_gradient(variable)
+        for replica, gradient in enumerate(stacked_graph.get_gradient(replicas)):
+            assert np.allclose(gradient, expected), \
+                "Replica {} of a stacked {} has a gradient that differs by up to {:g} from the unstacked model's".format(
+                    replica, type(model).__name__, np.max(np.abs(gradient - expected)))
+
+@check
+def check_replica_gradients():
+    import models, backend
+    np_random = np.random.RandomState(0)
+    x = np.linspace(-2 * np.pi, 2 * np.pi, num=16)[:, np.newaxis]
+    assert_replica_gradients(models.RegressionModel(), x, np.sin(x))
+    assert_replica_gradients(models.OddRegressionModel(), x, np.sin(x))
+    assert_replica_gradients(models.DigitClassificationModel(),
+                             np_random.uniform(size=(16, 784)),
+                             np.eye(10)[np_random.randint(10, size=16)])
+    assert_replica_gradients(models.DeepQModel(),
+                             np_random.normal(size=(16, 4)),
+                             np_random.normal(size=(16, 2)))
+    # Batch sizes both different from and equal to the number of replicas
+    data = backend.LanguageIDData()
+    for batch_size in [16, 2]:
+        xs, y = data.sample_padded(batch_size, np_random)
+        assert_replica_gradients(models.LanguageIDModel(), xs, y)
+
+@check
+def check_shared_prefixes():
+    # Prefix-shared inference must agree with `run`, including on words that
+    # end early and on words without any characters
+    import models, backend
+    model = models.LanguageIDModel()
+    data = backend.LanguageIDData()
+    char_ids = np.array([[-1, -1, -1], [3, -1, -1], [3, 7, -1], [3, 7, 1]])
+    xs, y = data.encode(char_ids, np.zeros(len(char_ids), dtype=int))
+    expected = model.run(xs)
+    shared = model.run_shared_prefixes(char_ids)
+    assert np.allclose(shared, expected), \
+        "LanguageIDModel.run_shared_prefixes gave scores {} where run gave {}".format(shared, expected)
+
+@check
+def check_replay_resume():
+    # Transitions written to a memory-mapped replay memory survive reopening,
+    # and a DeepQModel can resume training from them
+    import models, backend
+    import os, shutil, tempfile
+    path = tempfile.mkdtemp()
+    try:
+        memory = backend.MemmapReplayMemory(10, path)
+        states = np.arange(24, dtype=float).reshape(6, 4)
+        for i in range(6):
+            memory.push(states[i], i % 2, float(i), states[i] + 1, i == 5)
+        memory.flush()
+        del memory
+
+        memory = backend.MemmapReplayMemory(10, path)
+        assert len(memory) == 6, "Reopened replay memory has {} transitions, not 6".format(len(memory))
+        assert np.array_equal(memory.columns.state[:6], states)
+        assert np.array_equal(memory.columns.reward[:6], np.arange(6.0))
+        assert list(memory.columns.done[:6]) == [False] * 5 + [True]
+        del memory
+
+        shutil.rmtree(path)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for _ in range(2):
+                model = models.DeepQModel()
+                model.train(max_steps=50, replay_path=path, replay_capacity=1000)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
 if __name__ == '__main__':
     main()
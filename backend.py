@@ -1,28 +1,310 @@
 import collections
+import contextlib
+import copy
 import math
+import multiprocessing
 import os
 import os.path
+import queue
 import random
+import threading
 import time
 import weakref
 from collections import deque, namedtuple
 
-import matplotlib.pyplot as plt
 import numpy as np
 
 use_graphics = True
+# Draw figures in a separate process, so that training never waits on them
+render_in_subprocess = True
+# Minimum wall-clock time between two frames of the same figure, in seconds
+render_interval = 1.0 / 30
+# Number of undrawn frames to buffer before the oldest ones are dropped
+render_queue_size = 2
+# Number of training example ids that LanguageIDData draws ahead at once
+sample_schedule_size = 2 ** 16
+
+renderers = []
 
 def maybe_sleep_and_close(seconds):
-    if use_graphics and plt.get_fignums():
+    if use_graphics and renderers:
+        for renderer in list(renderers):
+            renderer.flush()
         time.sleep(seconds)
-        for fignum in plt.get_fignums():
-            fig = plt.figure(fignum)
-            plt.close(fig)
+        for renderer in list(renderers):
+            renderer.close()
+
+def close_figure(fig):
+    import matplotlib.pyplot as plt
+    plt.close(fig)
+    try:
+        # This raises a TclError on some Windows machines
+        fig.canvas.start_event_loop(1e-3)
+    except:
+        pass
+
+def refresh_figure(fig):
+    fig.canvas.draw_idle()
+    fig.canvas.start_event_loop(1e-3)
+
+def run_renderer(states, view, args):
+    """Draws frames from `states` until the None sentinel arrives"""
+    fig, update = view(*args)
+    while True:
+        try:
+            state = states.get(timeout=render_interval)
+        except queue.Empty:
+            # Keep the window responsive while training is between frames
+            fig.canvas.start_event_loop(1e-3)
+            continue
+        if state is None:
+            break
+        update(state)
+        refresh_figure(fig)
+    close_figure(fig)
+
+class Renderer(object):
+    def __init__(self, view, *args):
+        """Draws a figure from lightweight state snapshots
+
+        `view(*args)` creates the figure and returns (fig, update), where
+        update(state) redraws the figure's artists from a snapshot. If
+        `render_in_subprocess` is set, the view lives in a separate process
+        fed by a bounded queue that drops the oldest frames when the renderer
+        falls behind, so `view` and `args` must be picklable. Frames are
+        rate-limited to one every `render_interval` seconds of wall-clock time.
+
+        Args:
+            view (function): Module-level figure factory
+            args: Arguments for `view`, e.g. the static data to plot
+        """
+        self.last_draw = -float("inf")
+        self.latest = None
+        if render_in_subprocess:
+            context = multiprocessing.get_context("spawn")
+            self.states = context.Queue(render_queue_size)
+            self.process = context.Process(
+                target=run_renderer, args=(self.states, view, args))
+            self.process.daemon = True
+            self.process.start()
+        else:
+            self.process = None
+            self.fig, self.update = view(*args)
+        renderers.append(self)
+
+    def draw(self, state, force=False):
+        """Draws `state`, unless the last frame was drawn too recently
+
+        Skipped states are kept, so that `flush` can still draw the last one.
+        """
+        now = time.time()
+        if not force and now - self.last_draw < render_interval:
+            self.latest = state
+            return
+        self.last_draw = now
+        self.latest = None
+        if self.process is None:
+            self.update(state)
+            refresh_figure(self.fig)
+        else:
+            self.send(state)
+
+    def flush(self):
+        if self.latest is not None:
+            self.draw(self.latest, force=True)
+
+    def send(self, state):
+        while True:
             try:
-                # This raises a TclError on some Windows machines
-                fig.canvas.start_event_loop(1e-3)
-            except:
-                pass
+                self.states.put_nowait(state)
+                return
+            except queue.Full:
+                try:
+                    self.states.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        if self in renderers:
+            renderers.remove(self)
+        if self.process is None:
+            close_figure(self.fig)
+        else:
+            self.send(None)
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+            # Frames the renderer never read must not block interpreter exit
+            self.states.cancel_join_thread()
+
+def perceptron_view(x, y):
+    import matplotlib.pyplot as plt
+
+    points = len(x)
+    fig, ax = plt.subplots(1, 1)
+    limits = np.array([-3.0, 3.0])
+    ax.set_xlim(limits)
+    ax.set_ylim(limits)
+    positive = ax.scatter(*x[y == 1, :-1].T, color="red", marker="+")
+    negative = ax.scatter(*x[y == -1, :-1].T, color="blue", marker="_")
+    line, = ax.plot([], [], color="black")
+    text = ax.text(0.03, 0.97, "", transform=ax.transAxes, va="top")
+    ax.legend([positive, negative], [1, -1])
+    plt.show(block=False)
+
+    def update(state):
+        epoch, point, w = state
+        if w[1] != 0:
+            line.set_data(limits, (-w[0] * limits - w[2]) / w[1])
+        elif w[0] != 0:
+            line.set_data(np.full(2, -w[2] / w[0]), limits)
+        else:
+            line.set_data([], [])
+        text.set_text("epoch: {:,}\npoint: {:,}/{:,}\nweights: {}\n"
+                      "showing every {:,} updates".format(
+            epoch, point, points, w, min(2 ** (epoch + 1), points)))
+
+    return fig, update
+
+def regression_view(x, y, iterations):
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(1, 1)
+    ax.set_xlim(-2 * np.pi, 2 * np.pi)
+    ax.set_ylim(-1.4, 1.4)
+    real, = ax.plot(x, y, color="blue")
+    learned, = ax.plot([], [], color="red")
+    text = ax.text(0.03, 0.97, "", transform=ax.transAxes, va="top")
+    ax.legend([real, learned], ["real", "learned"])
+    plt.show(block=False)
+
+    def update(state):
+        iteration, predicted, loss = state
+        learned.set_data(x, predicted)
+        text.set_text("iteration: {:,}/{:,}\nloss: {:.6f}".format(
+            iteration, iterations, loss))
+
+    return fig, update
+
+def digit_classification_view(mnist_path, epochs):
+    import matplotlib.pyplot as plt
+
+    # The view loads the dev set itself so that only logits cross processes
+    with np.load(mnist_path) as data:
+        dev_images = data["test_images"]
+        dev_labels = data["test_labels"]
+
+    width = 20  # Width of each row expressed as a multiple of image width
+    samples = 100  # Number of images to display per label
+    fig = plt.figure()
+    ax = {}
+    images = collections.defaultdict(list)
+    texts = collections.defaultdict(list)
+    for i in reversed(range(10)):
+        ax[i] = plt.subplot2grid((30, 1), (3 * i, 0), 2, 1, sharex=ax.get(9))
+        plt.setp(ax[i].get_xticklabels(), visible=i == 9)
+        ax[i].set_yticks([])
+        ax[i].text(-0.03, 0.5, i, transform=ax[i].transAxes, va="center")
+        ax[i].set_xlim(0, 28 * width)
+        ax[i].set_ylim(0, 28)
+        for j in range(samples):
+            images[i].append(ax[i].imshow(
+                np.zeros((28, 28)), vmin=0, vmax=1, cmap="Greens", alpha=0.3))
+            texts[i].append(ax[i].text(
+                0, 0, "", ha="center", va="top", fontsize="smaller"))
+    ax[9].set_xticks(np.linspace(0, 28 * width, 11))
+    ax[9].set_xticklabels(np.linspace(0, 1, 11))
+    ax[9].tick_params(axis="x", pad=16)
+    ax[9].set_xlabel("Probability of Correct Label")
+    status = ax[0].text(
+        0.5, 1.5, "", transform=ax[0].transAxes, ha="center", va="bottom")
+    plt.show(block=False)
+
+    def softmax(x):
+        exp = np.exp(x - np.max(x, axis=1, keepdims=True))
+        return exp / np.sum(exp, axis=1, keepdims=True)
+
+    def update(state):
+        epoch, dev_logits = state
+        dev_predicted = np.argmax(dev_logits, axis=1)
+        dev_accuracy = np.mean(dev_predicted == dev_labels)
+        status.set_text("epoch: {:.2f}/{:.2f}, validation-accuracy: {:.2%}".format(
+            epoch, epochs, dev_accuracy))
+        dev_probs = softmax(dev_logits)
+        for i in range(10):
+            predicted = dev_predicted[dev_labels == i]
+            probs = dev_probs[dev_labels == i][:, i]
+            linspace = np.linspace(0, len(probs) - 1, samples).astype(int)
+            indices = probs.argsort()[linspace]
+            for j, (prob, image) in enumerate(zip(
+                    probs[indices], dev_images[dev_labels == i][indices])):
+                images[i][j].set_data(image.reshape((28, 28)))
+                left = prob * (width - 1) * 28
+                if predicted[indices[j]] == i:
+                    images[i][j].set_cmap("Greens")
+                    texts[i][j].set_text("")
+                else:
+                    images[i][j].set_cmap("Reds")
+                    texts[i][j].set_text(predicted[indices[j]])
+                    texts[i][j].set_x(left + 14)
+                images[i][j].set_extent([left, left + 28, 0, 28])
+
+    return fig, update
+
+def cartpole_view(x_threshold, n_episode):
+    import matplotlib.patches as patches
+    import matplotlib.pyplot as plt
+
+    cart_width = 1.0
+    cart_height = 0.1
+    pole_width = 0.05
+    pole_height = 2.0
+
+    def get_cart_coords(x):
+        return [
+            (x - cart_width / 2, -cart_height),
+            (x + cart_width / 2, -cart_height),
+            (x + cart_width / 2, cart_height),
+            (x - cart_width / 2, cart_height),
+        ]
+
+    def get_pole_coords(x, theta):
+        bottom_left = np.array([
+            x + pole_width * np.cos(np.pi - theta),
+            pole_width * np.sin(np.pi - theta)])
+        bottom_right = np.array([
+            x + pole_width * np.cos(-theta),
+            pole_width * np.sin(-theta)])
+        top_offset = np.array([
+            pole_height * np.cos(np.pi / 2 - theta),
+            pole_height * np.sin(np.pi / 2 - theta)])
+        return [
+            bottom_left,
+            bottom_right,
+            bottom_right + top_offset,
+            bottom_left + top_offset
+        ]
+
+    fig, ax = plt.subplots(1, 1)
+    ax.set_xlim(-x_threshold - cart_width, x_threshold + cart_width)
+    ax.set_ylim(-cart_height / 2, pole_height * 1.1)
+    ax.set_aspect("equal")
+    cart_polygon = patches.Polygon(get_cart_coords(0), color="black")
+    pole_polygon = patches.Polygon(get_pole_coords(0, 0), color="blue")
+    ax.add_patch(pole_polygon)
+    ax.add_patch(cart_polygon)
+    text = ax.text(0.02, 0.95, "", transform=ax.transAxes, va="top")
+    plt.show(block=False)
+
+    def update(state):
+        episode, x, theta, total_reward = state
+        cart_polygon.set_xy(get_cart_coords(x))
+        pole_polygon.set_xy(get_pole_coords(x, theta))
+        text.set_text("episode: {:,}/{:,}\nreward: {}".format(
+            episode, n_episode, total_reward))
+
+    return fig, update
 
 # Stats should include all of the key quantities used for grading.
 # This backend file deals with all data loading / environment construction, so
@@ -36,6 +318,31 @@ def get_stats(model):
 def set_stats(model, stats_dict):
     all_stats[model] = stats_dict
 
+@contextlib.contextmanager
+def swapped_parameters(variables, values):
+    """Temporarily replaces the `.data` of each variable
+
+    Args:
+        variables (List[nn.Variable]): Parameters of a model
+        values (List[np.ndarray]): Replacement arrays, one per variable
+    """
+    saved = [variable.data for variable in variables]
+    for variable, value in zip(variables, values):
+        variable.data = value
+    try:
+        yield
+    finally:
+        for variable, value in zip(variables, saved):
+            variable.data = value
+
+def count_evaluation(stats):
+    """Marks that the metrics in `stats` were just updated
+
+    Schedules and criteria that count evaluations use the 'evaluations'
+    counter, since a metric may take the same value twice in a row.
+    """
+    stats['evaluations'] = stats.get('evaluations', 0) + 1
+
 def get_data_path(filename):
     path = os.path.join(
         os.path.dirname(__file__), os.pardir, "data", filename)
@@ -50,23 +357,91 @@ def get_data_path(filename):
 
     return path
 
-def make_get_data_and_monitor_perceptron():
-    points = 500
+class StopCriterion(object):
+    def __init__(self, metric, target=None, mode="min", patience=None,
+                 min_delta=0.0, time_budget=None):
+        """Decides when to end training early, based on a model's stats
+
+        The `get_data_and_monitor_*` functions accept a `stop_criterion`, and
+        consult it each time they update the stats. For example,
+            model.train(stop_criterion=StopCriterion("loss", target=0.02))
+
+        Args:
+            metric (str): Key in the stats dict, e.g. "loss" or "dev_accuracy"
+            target (float): Stop as soon as the metric reaches this value
+            mode (str): "min" if lower values of the metric are better,
+                "max" if higher values are better
+            patience (int): Stop after this many consecutive evaluations
+                without an improvement of more than `min_delta`
+            min_delta (float): Smallest change that counts as an improvement
+            time_budget (float): Stop after this many seconds of training
+        """
+        assert mode in ("min", "max"), "mode must be 'min' or 'max'"
+        self.metric = metric
+        self.target = target
+        self.mode = mode
+        self.patience = patience
+        self.min_delta = min_delta
+        self.time_budget = time_budget
+        self.start()
+
+    def start(self):
+        """Resets the criterion at the beginning of a training run"""
+        self.start_time = time.time()
+        self.best = None
+        self.evaluations_without_improvement = 0
+        self.reason = None
+        # Whether training stopped because the metric reached the target
+        self.reached_target = False
+
+    def improvement(self, value):
+        if self.best is None:
+            return float("inf")
+        if self.mode == "min":
+            return self.best - value
+        return value - self.best
+
+    def update(self, stats):
+        """Records the latest stats, returning True if training should stop
+
+        Args:
+            stats (dict): The stats dict maintained by the backend
+        """
+        if (self.time_budget is not None
+                and time.time() - self.start_time >= self.time_budget):
+            self.reason = "time budget of {}s reached".format(self.time_budget)
+            return True
+
+        value = stats.get(self.metric)
+        if value is None:
+            return False
+
+        if self.target is not None and (
+                value <= self.target if self.mode == "min"
+                else value >= self.target):
+            self.reason = "{} reached target {}".format(self.metric, self.target)
+            self.reached_target = True
+            return True
+
+        if self.improvement(value) > self.min_delta:
+            self.best = value
+            self.evaluations_without_improvement = 0
+        else:
+            self.evaluations_without_improvement += 1
+            if (self.patience is not None
+                    and self.evaluations_without_improvement >= self.patience):
+                self.reason = "{} did not improve for {} evaluations".format(
+                    self.metric, self.patience)
+                return True
+        return False
+
+def make_get_data_and_monitor_perceptron(points=500):
 
     x = np.hstack([np.random.randn(points, 2), np.ones((points, 1))])
     y = np.where(x[:, 0] + 2 * x[:, 1] - 1 >= 0, 1, -1)
 
     if use_graphics:
-        fig, ax = plt.subplots(1, 1)
-        limits = np.array([-3.0, 3.0])
-        ax.set_xlim(limits)
-        ax.set_ylim(limits)
-        positive = ax.scatter(*x[y == 1, :-1].T, color="red", marker="+")
-        negative = ax.scatter(*x[y == -1, :-1].T, color="blue", marker="_")
-        line, = ax.plot([], [], color="black")
-        text = ax.text(0.03, 0.97, "", transform=ax.transAxes, va="top")
-        ax.legend([positive, negative], [1, -1])
-        plt.show(block=False)
+        renderer = Renderer(perceptron_view, x, y)
 
     def monitor(perceptron, epoch, point, log):
         w = perceptron.get_weights()
@@ -76,27 +451,25 @@ def make_get_data_and_monitor_perceptron():
                 epoch, point, points, w))
 
         if use_graphics:
-            if w[1] != 0:
-                line.set_data(limits, (-w[0] * limits - w[2]) / w[1])
-            elif w[0] != 0:
-                line.set_data(np.full(2, -w[2] / w[0]), limits)
-            else:
-                line.set_data([], [])
-            text.set_text("epoch: {:,}\npoint: {:,}/{:,}\nweights: {}\n"
-                          "showing every {:,} updates".format(
-                epoch, point, points, w, min(2 ** (epoch + 1), points)))
-            fig.canvas.draw_idle()
-            fig.canvas.start_event_loop(1e-3)
+            renderer.draw((epoch, point, np.array(w)), force=log)
 
     # Use a dictionary since the `nonlocal` keyword doesn't exist in Python 2
     nonlocals = {"epoch": 0}
     stats = {}
 
-    def get_data_and_monitor_perceptron(perceptron):
-        for i in range(points):
-            yield x[i], y[i]
-            if i % (2 ** (nonlocals["epoch"] + 1)) == 0:
-                monitor(perceptron, nonlocals["epoch"], i, False)
+    def get_data_and_monitor_perceptron(perceptron, batch=False):
+        """
+        Runs one epoch, yielding data points one at a time. If `batch` is
+        True, the whole dataset is instead yielded once as an (x, y) pair of
+        arrays.
+        """
+        if batch:
+            yield x, y
+        else:
+            for i in range(points):
+                yield x[i], y[i]
+                if i % (2 ** (nonlocals["epoch"] + 1)) == 0:
+                    monitor(perceptron, nonlocals["epoch"], i, False)
 
         monitor(perceptron, nonlocals["epoch"], points, True)
         nonlocals["epoch"] += 1
@@ -104,71 +477,182 @@ def make_get_data_and_monitor_perceptron():
         set_stats(perceptron, stats)
         w = perceptron.get_weights()
         stats['accuracy'] = np.mean(np.where(np.dot(x, w) >= 0, 1, -1) == y)
+        count_evaluation(stats)
 
+    # Lets Perceptron.train pick a training method suited to the dataset size
+    get_data_and_monitor_perceptron.points = points
     return get_data_and_monitor_perceptron
 
-def get_data_and_monitor_regression(model):
+class AsyncMonitor(object):
+    def __init__(self, evaluate, report, enabled=True):
+        """Runs validation in a background thread, off the training loop
+
+        When called, the monitor snapshots the model and starts
+        `evaluate(snapshot)` in a background thread, unless an earlier
+        evaluation is still running. Results are handed to `report` on the
+        training thread (which owns the stats dict and any graphics) the next
+        time the monitor is called, labelled with the progress at which the
+        snapshot was taken. If `enabled` is False, every call evaluates and
+        reports synchronously. An exception raised by a background evaluation
+        is raised again on the training thread, by the call that would have
+        reported its results.
+
+        Args:
+            evaluate (function): Maps a model to evaluation results. Must not
+                modify shared state
+            report (function): Called as report(progress, results, log)
+            enabled (bool): Whether to evaluate in the background
+        """
+        self.evaluate = evaluate
+        self.report = report
+        self.enabled = enabled
+        self.thread = None
+        self.pending = None
+        self.error = None
+        self.last_progress = None
+
+    def run(self, snapshot, progress, log):
+        try:
+            self.pending = (progress, log, self.evaluate(snapshot))
+        except Exception as error:
+            self.error = error
+
+    def raise_error(self):
+        """Raises the exception of a failed background evaluation, if any"""
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def poll(self):
+        """Reports a finished background evaluation, returning True if any"""
+        if self.thread is None or self.thread.is_alive():
+            return False
+        self.thread = None
+        self.raise_error()
+        progress, log, results = self.pending
+        self.pending = None
+        self.report(progress, results, log)
+        self.last_progress = progress
+        return True
+
+    def __call__(self, model, progress, log):
+        """Returns True if new results were reported during this call"""
+        if not self.enabled:
+            self.report(progress, self.evaluate(model), log)
+            self.last_progress = progress
+            return True
+
+        reported = self.poll()
+        if self.thread is None:
+            snapshot = copy.deepcopy(model)
+            self.thread = threading.Thread(
+                target=self.run, args=(snapshot, progress, log))
+            self.thread.daemon = True
+            self.thread.start()
+        return reported
+
+    def finish(self, model, progress, log=True):
+        """Discards any running evaluation and evaluates synchronously
+
+        The evaluation is skipped if results for this same progress were
+        already reported, since the model has not been trained since.
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            self.pending = None
+            self.raise_error()
+        if progress != self.last_progress:
+            self.report(progress, self.evaluate(model), log)
+            self.last_progress = progress
+
+def should_stop(stop_criterion, stats):
+    """Consults an optional StopCriterion, reporting why training ends early"""
+    if stop_criterion is None or not stop_criterion.update(stats):
+        return False
+    print("Stopping early: {}".format(stop_criterion.reason))
+    return True
+
+def get_data_and_monitor_regression(model, stop_criterion=None,
+                                    async_eval=False, max_steps=None):
     stats = {}
     set_stats(model, stats)
+    if stop_criterion is not None:
+        stop_criterion.start()
 
     points = 200
     iterations = 20000
+    if max_steps is not None:
+        iterations = min(iterations, max_steps)
 
     x = np.linspace(-2 * np.pi, 2 * np.pi, num=points)[:, np.newaxis]
     y = np.sin(x)
 
     if use_graphics:
-        fig, ax = plt.subplots(1, 1)
-        ax.set_xlim(-2 * np.pi, 2 * np.pi)
-        ax.set_ylim(-1.4, 1.4)
-        real, = ax.plot(x, y, color="blue")
-        learned, = ax.plot([], [], color="red")
-        text = ax.text(0.03, 0.97, "", transform=ax.transAxes, va="top")
-        ax.legend([real, learned], ["real", "learned"])
-        plt.show(block=False)
-
-    def monitor(iteration, log):
-        predicted = model.run(x)
-        loss = np.mean(np.square(predicted - y) / 2)
+        renderer = Renderer(regression_view, x, y, iterations)
+
+    def evaluate(model):
+        return model.run(x)
+
+    def report(iteration, predicted, log):
+        # Replica-stacked models predict (K x points x 1); the best replica's
+        # loss is the one graded
+        losses = np.mean(np.square(predicted - y) / 2, axis=(-2, -1))
+        best = np.argmin(losses)
+        loss = np.min(losses)
         stats['loss'] = loss
+        count_evaluation(stats)
+        if predicted.ndim > 2:
+            stats['replica_losses'] = losses
 
         assert np.allclose(x, -x[::-1,:])
-        asymmetry = np.abs(predicted + predicted[::-1])
+        asymmetry = np.abs(predicted + predicted[..., ::-1, :])
         stats['max_asymmetry'] = np.max(asymmetry)
-        stats['max_asymmetry_x'] = float(x[np.argmax(asymmetry)])
+        stats['max_asymmetry_x'] = float(
+            x[np.unravel_index(np.argmax(asymmetry), asymmetry.shape)[-2]])
 
         if log:
-            print("iteration {:,}/{:,} loss {:.6f}".format(
-                iteration, iterations, loss))
+            if predicted.ndim > 2:
+                print("iteration {:,}/{:,} losses {}".format(
+                    iteration, iterations,
+                    " ".join("{:.6f}".format(l) for l in losses)))
+            else:
+                print("iteration {:,}/{:,} loss {:.6f}".format(
+                    iteration, iterations, loss))
 
         if use_graphics:
-            learned.set_data(x, predicted)
-            text.set_text("iteration: {:,}/{:,}\nloss: {:.6f}".format(
-                iteration, iterations, loss))
-            fig.canvas.draw_idle()
-            fig.canvas.start_event_loop(1e-3)
+            if predicted.ndim > 2:
+                predicted = predicted[best]
+            renderer.draw((iteration, predicted, loss))
+
+    monitor = AsyncMonitor(evaluate, report, async_eval)
 
+    # The monitor skips the final evaluation if it has already reported this
+    # same progress, so an early stop passes the value it last handed over
+    progress = iterations
     for iteration in range(iterations):
         yield x, y
         if iteration % 20 == 0:
-            monitor(iteration, iteration % 1000 == 0)
+            if (monitor(model, iteration, iteration % 1000 == 0)
+                    and should_stop(stop_criterion, stats)):
+                progress = iteration
+                break
 
-    monitor(iterations, True)
+    monitor.finish(model, progress)
 
     if use_graphics:
-        plt.close(fig)
-        try:
-            # This raises a TclError on some Windows machines
-            fig.canvas.start_event_loop(1e-3)
-        except:
-            pass
+        renderer.flush()
+        renderer.close()
 
-def get_data_and_monitor_digit_classification(model):
+def get_data_and_monitor_digit_classification(model, stop_criterion=None,
+                                              async_eval=False, batch_size=100,
+                                              max_steps=None):
     stats = {}
     set_stats(model, stats)
+    if stop_criterion is not None:
+        stop_criterion.start()
 
     epochs = 5
-    batch_size = 100
 
     mnist_path = get_data_path("mnist.npz")
 
@@ -184,108 +668,308 @@ def get_data_and_monitor_digit_classification(model):
     train_labels_one_hot[range(num_train), train_labels] = 1
 
     if use_graphics:
-        width = 20  # Width of each row expressed as a multiple of image width
-        samples = 100  # Number of images to display per label
-        fig = plt.figure()
-        ax = {}
-        images = collections.defaultdict(list)
-        texts = collections.defaultdict(list)
-        for i in reversed(range(10)):
-            ax[i] = plt.subplot2grid((30, 1), (3 * i, 0), 2, 1, sharex=ax.get(9))
-            plt.setp(ax[i].get_xticklabels(), visible=i == 9)
-            ax[i].set_yticks([])
-            ax[i].text(-0.03, 0.5, i, transform=ax[i].transAxes, va="center")
-            ax[i].set_xlim(0, 28 * width)
-            ax[i].set_ylim(0, 28)
-            for j in range(samples):
-                images[i].append(ax[i].imshow(
-                    np.zeros((28, 28)), vmin=0, vmax=1, cmap="Greens", alpha=0.3))
-                texts[i].append(ax[i].text(
-                    0, 0, "", ha="center", va="top", fontsize="smaller"))
-        ax[9].set_xticks(np.linspace(0, 28 * width, 11))
-        ax[9].set_xticklabels(np.linspace(0, 1, 11))
-        ax[9].tick_params(axis="x", pad=16)
-        ax[9].set_xlabel("Probability of Correct Label")
-        status = ax[0].text(
-            0.5, 1.5, "", transform=ax[0].transAxes, ha="center", va="bottom")
-        plt.show(block=False)
+        renderer = Renderer(digit_classification_view, mnist_path, epochs)
 
-    def softmax(x):
-        exp = np.exp(x - np.max(x, axis=1, keepdims=True))
-        return exp / np.sum(exp, axis=1, keepdims=True)
+    def evaluate(model):
+        return model.run(dev_images)
 
-    def monitor(epoch, log):
-        dev_logits = model.run(dev_images)
+    def report(epoch, dev_logits, log):
         dev_predicted = np.argmax(dev_logits, axis=1)
         dev_accuracy = np.mean(dev_predicted == dev_labels)
         stats['dev_accuracy'] = dev_accuracy
+        count_evaluation(stats)
 
         if log:
             print("epoch {:.2f}/{:.2f} validation-accuracy {:.2%}".format(
                 epoch, epochs, dev_accuracy))
 
         if use_graphics:
-            status.set_text("epoch: {:.2f}/{:.2f}, validation-accuracy: {:.2%}".format(
-                epoch, epochs, dev_accuracy))
-            dev_probs = softmax(dev_logits)
-            for i in range(10):
-                predicted = dev_predicted[dev_labels == i]
-                probs = dev_probs[dev_labels == i][:, i]
-                linspace = np.linspace(0, len(probs) - 1, samples).astype(int)
-                indices = probs.argsort()[linspace]
-                for j, (prob, image) in enumerate(zip(
-                        probs[indices], dev_images[dev_labels == i][indices])):
-                    images[i][j].set_data(image.reshape((28, 28)))
-                    left = prob * (width - 1) * 28
-                    if predicted[indices[j]] == i:
-                        images[i][j].set_cmap("Greens")
-                        texts[i][j].set_text("")
-                    else:
-                        images[i][j].set_cmap("Reds")
-                        texts[i][j].set_text(predicted[indices[j]])
-                        texts[i][j].set_x(left + 14)
-                    images[i][j].set_extent([left, left + 28, 0, 28])
-            fig.canvas.draw_idle()
-            fig.canvas.start_event_loop(1e-3)
+            renderer.draw((epoch, dev_logits))
 
+    monitor = AsyncMonitor(evaluate, report, async_eval)
+    progress = epochs
+    stopped = False
+    steps = 0
     for epoch in range(epochs):
         for index in range(0, num_train, batch_size):
             x = train_images[index:index + batch_size]
             y = train_labels_one_hot[index:index + batch_size]
             yield x, y
-            if index % 5000 == 0:
-                monitor(epoch + 1.0 * index / num_train, index % 15000 == 0)
-
-    monitor(epochs, True)
+            steps += 1
+            if max_steps is not None and steps >= max_steps:
+                progress = epoch + 1.0 * (index + len(x)) / num_train
+                stopped = True
+                break
+            if index % 5000 < batch_size:
+                if (monitor(model, epoch + 1.0 * index / num_train,
+                            index % 15000 < batch_size)
+                        and should_stop(stop_criterion, stats)):
+                    # As handed to the monitor, whose results are then reused
+                    progress = epoch + 1.0 * index / num_train
+                    stopped = True
+                    break
+        if stopped:
+            break
+
+    monitor.finish(model, progress)
 
     if use_graphics:
-        plt.close(fig)
-        try:
-            # This raises a TclError on some Windows machines
-            fig.canvas.start_event_loop(1e-3)
-        except:
-            pass
+        renderer.flush()
+        renderer.close()
+
+def alias_table(weights):
+    """Builds Vose's alias table, for O(1) sampling from a discrete distribution
+
+    Index k is drawn by picking a column uniformly, then keeping it with
+    probability `probs[k]`, or taking `aliases[k]` otherwise.
+
+    Args:
+        weights (np.array): Probabilities, which sum to 1
+
+    Returns:
+        tuple: (probs, aliases) arrays, each of the same length as `weights`
+    """
+    num_columns = len(weights)
+    scaled = list(np.asarray(weights, dtype=float) * num_columns)
+    probs = np.ones(num_columns)
+    aliases = np.arange(num_columns)
+    small = [k for k in range(num_columns) if scaled[k] < 1.0]
+    large = [k for k in range(num_columns) if scaled[k] >= 1.0]
+    while small and large:
+        k = small.pop()
+        alias = large.pop()
+        probs[k] = scaled[k]
+        aliases[k] = alias
+        scaled[alias] -= 1.0 - scaled[k]
+        (small if scaled[alias] < 1.0 else large).append(alias)
+    # Whatever is left over has a probability of 1, up to rounding error
+    return probs, aliases
+
+# Maps each character of lang_id.npz to its id, once loaded
+lang_id_char_index = None
+
+def get_char_ids(word):
+    """Returns the character ids of `word`, lowercased like the dataset
+
+    Only the alphabet of lang_id.npz is loaded, the first time this is called.
+
+    Returns:
+        list: One id per character, or None if `word` has a character outside
+            the alphabet
+    """
+    global lang_id_char_index
+    if lang_id_char_index is None:
+        with np.load(get_data_path("lang_id.npz")) as data:
+            lang_id_char_index = {
+                char: i for i, char in enumerate(data['chars'])}
+    row = []
+    for char in word.lower():
+        if char not in lang_id_char_index:
+            return None
+        row.append(lang_id_char_index[char])
+    return row
+
+def pad_char_ids(rows):
+    """Stacks lists of character ids into an array, padded with -1"""
+    ids = np.full((len(rows), max([len(row) for row in rows] + [1])),
+                  -1, dtype=np.int64)
+    for i, row in enumerate(rows):
+        ids[i, :len(row)] = row
+    return ids
+
+class LanguageIDData(object):
+    def __init__(self):
+        """Loads the language identification dataset
+
+        Words are stored as rows of character ids padded with -1, grouped into
+        buckets of consecutive rows that share a word length.
+
+        Encoded words are lists of one-hot rows, one list entry per position,
+        where padding is encoded as an all-zero row. Models tell how long
+        each word in a batch is from the zero rows, so a batch may mix words
+        of different lengths.
+        """
+        with np.load(get_data_path("lang_id.npz")) as data:
+            self.chars = data['chars']
+            self.language_codes = data['language_codes']
+            self.language_names = data['language_names']
 
-def get_data_and_monitor_lang_id(model):
-    stats = {}
-    set_stats(model, stats)
+            self.train_x = data['train_x']
+            self.train_y = data['train_y']
+            self.train_buckets = data['train_buckets']
+            self.dev_x = data['test_x']
+            self.dev_y = data['test_y']
+            self.dev_buckets = data['test_buckets']
+
+        self.num_chars = len(self.chars)
+        self.num_langs = len(self.language_names)
+
+        # One-hot rows by character id, followed by the zero row for id -1
+        self.char_vectors = np.vstack(
+            [np.eye(self.num_chars), np.zeros((1, self.num_chars))])
+
+        bucket_weights = self.train_buckets[:,1] - self.train_buckets[:,0]
+        self.bucket_weights = bucket_weights / float(bucket_weights.sum())
+        self.bucket_probs, self.bucket_aliases = alias_table(
+            self.bucket_weights)
+
+        # Example ids drawn ahead, by (random_state, batch_size, padded), as
+        # [array of batches, index of the next batch]
+        self.schedules = {}
+
+        # Dev labels in the order that `predict` returns scores
+        self.dev_correct = np.concatenate(
+            [self.dev_y[start:end] for start, end in self.dev_buckets])
+
+    def char_ids(self, words):
+        """Converts words to rows of character ids, padded with -1
+
+        Words are lowercased, like those in the dataset.
+
+        Args:
+            words (list): Strings to convert
+
+        Returns:
+            np.array: (len(words) x length of the longest word) ids
+
+        Raises:
+            ValueError: If a word contains a character outside the alphabet
+        """
+        rows = []
+        for word in words:
+            row = get_char_ids(word)
+            if row is None:
+                raise ValueError(u"{!r} has a character outside the "
+                                 u"alphabet".format(word))
+            rows.append(row)
+        return pad_char_ids(rows)
+
+    def encode(self, inp_x, inp_y):
+        # Positions past the end of every word in the batch are left out
+        length = np.max(np.sum(inp_x != -1, axis=1))
+        xs = []
+        for i in range(length):
+            xs.append(self.char_vectors[inp_x[:,i]])
+        y = np.eye(self.num_langs)[inp_y]
+        return xs, y
+
+    def sample(self, batch_size, random_state=np.random):
+        """Encodes a training batch drawn from a single bucket
+
+        Buckets are chosen in proportion to their size, then examples are drawn
+        uniformly with replacement from within the bucket.
+
+        Args:
+            batch_size (int): Number of examples
+            random_state (np.random.RandomState): Source of randomness, the
+                global numpy generator by default
+        """
+        example_ids = self.next_example_ids(batch_size, random_state, False)
+        return self.encode(self.train_x[example_ids], self.train_y[example_ids])
+
+    def sample_padded(self, batch_size, random_state=np.random):
+        """Encodes a training batch of words of any length
+
+        Examples are drawn uniformly with replacement from the whole training
+        set, which is the same distribution that `sample` draws from, and
+        padded to the length of the longest word in the batch.
+
+        Args:
+            batch_size (int): Number of examples
+            random_state (np.random.RandomState): Source of randomness, the
+                global numpy generator by default
+        """
+        example_ids = self.next_example_ids(batch_size, random_state, True)
+        return self.encode(self.train_x[example_ids], self.train_y[example_ids])
 
-    iterations = 15000
-    batch_size = 16
+    def next_example_ids(self, batch_size, random_state, padded):
+        """Returns the example ids of the next batch in a drawn-ahead schedule
 
-    data_path = get_data_path("lang_id.npz")
+        Each pair of random state and sampler draws the ids of about
+        `sample_schedule_size` examples at once, in a few vectorized calls.
+        """
+        key = (random_state, batch_size, padded)
+        schedule = self.schedules.get(key)
+        if schedule is None or schedule[1] == len(schedule[0]):
+            num_batches = max(1, sample_schedule_size // batch_size)
+            schedule = [self.draw_schedule(
+                num_batches, batch_size, random_state, padded), 0]
+            self.schedules[key] = schedule
+        example_ids = schedule[0][schedule[1]]
+        schedule[1] += 1
+        return example_ids
+
+    def draw_schedule(self, num_batches, batch_size, random_state, padded):
+        """Draws the example ids of `num_batches` batches, one row per batch"""
+        if padded:
+            return random_state.randint(
+                len(self.train_x), size=(num_batches, batch_size))
+        # Buckets in proportion to their size, through the alias table
+        columns = random_state.randint(len(self.bucket_probs), size=num_batches)
+        keep = random_state.random_sample(num_batches) < self.bucket_probs[columns]
+        bucket_ids = np.where(keep, columns, self.bucket_aliases[columns])
+        starts = self.train_buckets[bucket_ids, 0]
+        sizes = self.train_buckets[bucket_ids, 1] - starts
+        offsets = random_state.random_sample((num_batches, batch_size))
+        offsets *= sizes[:, np.newaxis]
+        return starts[:, np.newaxis] + offsets.astype(np.int64)
+
+    def predict(self, model, padded=False, batch_size=1024,
+                shared_prefixes=False):
+        """Returns the model's scores for every dev example, in bucket order
+
+        By default, the model is run once per length bucket. With `padded`,
+        it is instead run on batches of up to `batch_size` words of mixed
+        lengths, which needs a model that handles padding. With
+        `shared_prefixes`, batches of that size are passed as character ids
+        to `model.run_shared_prefixes` instead.
+        """
+        if shared_prefixes:
+            return np.concatenate([
+                model.run_shared_prefixes(self.dev_x[start:start + batch_size])
+                for start in range(0, len(self.dev_x), batch_size)], axis=-2)
+        if padded:
+            batches = [(start, min(start + batch_size, len(self.dev_x)))
+                       for start in range(0, len(self.dev_x), batch_size)]
+        else:
+            batches = self.dev_buckets
+        all_predicted = []
+        for start, end in batches:
+            xs, y = self.encode(self.dev_x[start:end], self.dev_y[start:end])
+            predicted = model.run(xs)
 
-    with np.load(data_path) as data:
-        chars = data['chars']
-        language_codes = data['language_codes']
-        language_names = data['language_names']
+            all_predicted.extend(list(predicted))
+        return np.asarray(all_predicted)
+
+    def accuracy(self, model, padded=False, shared_prefixes=False):
+        predicted = self.predict(
+            model, padded, shared_prefixes=shared_prefixes)
+        return np.mean(predicted.argmax(axis=-1) == self.dev_correct)
+
+def get_data_and_monitor_lang_id(model, stop_criterion=None, async_eval=False,
+                                 padded=False, batch_size=16, iterations=15000,
+                                 max_steps=None):
+    """
+    Yields language ID training batches, monitoring dev accuracy every 1000.
+    If `max_steps` is given, at most that many batches are yielded before the
+    final evaluation.
+
+    By default, each batch holds words of a single length. With `padded`,
+    batches mix words of all lengths, padded with zero rows, and the dev set
+    is evaluated in a single pass. This lets larger batches keep the model's
+    matrices busy, e.g. batch_size=256 with fewer iterations.
+    """
+    stats = {}
+    set_stats(model, stats)
+    if stop_criterion is not None:
+        stop_criterion.start()
 
-        train_x = data['train_x']
-        train_y = data['train_y']
-        train_buckets = data['train_buckets']
-        dev_x = data['test_x']
-        dev_y = data['test_y']
-        dev_buckets = data['test_buckets']
+    data = LanguageIDData()
+    chars = data.chars
+    language_codes = data.language_codes
+    language_names = data.language_names
+    dev_x = data.dev_x
+    dev_y = data.dev_y
 
     chars_print = chars
     try:
@@ -300,11 +984,7 @@ For the purposes of printing to the terminal, some of the letters in the
 alphabet above have been substituted with ASCII symbols.""".strip())
     print("")
 
-    num_chars = len(chars)
-    num_langs = len(language_names)
-
-    bucket_weights = train_buckets[:,1] - train_buckets[:,0]
-    bucket_weights = bucket_weights / float(bucket_weights.sum())
+    num_langs = data.num_langs
 
     # Select some examples to spotlight in the monitoring phase (3 per language)
     spotlight_idxs = []
@@ -314,13 +994,6 @@ alphabet above have been substituted with ASCII symbols.""".strip())
         spotlight_idxs.extend(list(idxs_lang_i))
     spotlight_idxs = np.array(spotlight_idxs, dtype=int)
 
-    def encode(inp_x, inp_y):
-        xs = []
-        for i in range(inp_x.shape[1]):
-            xs.append(np.eye(num_chars)[inp_x[:,i]])
-        y = np.eye(num_langs)[inp_y]
-        return xs, y
-
     def make_templates():
         max_word_len = dev_x.shape[1]
         max_lang_len = max([len(x) for x in language_names])
@@ -345,23 +1018,15 @@ alphabet above have been substituted with ASCII symbols.""".strip())
         exp = np.exp(x - np.max(x, axis=-1, keepdims=True))
         return exp / np.sum(exp, axis=-1, keepdims=True)
 
-    def monitor(iteration):
-        all_predicted = []
-        all_correct = []
-        for bucket_id in range(dev_buckets.shape[0]):
-            start, end = dev_buckets[bucket_id]
-            xs, y = encode(dev_x[start:end], dev_y[start:end])
-            predicted = model.run(xs)
-
-            all_predicted.extend(list(predicted))
-            all_correct.extend(list(dev_y[start:end]))
+    all_correct = data.dev_correct
 
-        all_predicted_probs = softmax(np.asarray(all_predicted))
-        all_predicted = np.asarray(all_predicted).argmax(axis=-1)
-        all_correct = np.asarray(all_correct)
+    def report(iteration, all_predicted, log):
+        all_predicted_probs = softmax(all_predicted)
+        all_predicted = all_predicted.argmax(axis=-1)
 
         dev_accuracy = np.mean(all_predicted == all_correct)
         stats['dev_accuracy'] = dev_accuracy
+        count_evaluation(stats)
 
         print("iteration {:,} accuracy {:.1%}".format(
             iteration, dev_accuracy))
@@ -380,16 +1045,23 @@ alphabet above have been substituted with ASCII symbols.""".strip())
             ))
         print("")
 
+    def evaluate(model):
+        return data.predict(model, padded)
+
+    monitor = AsyncMonitor(evaluate, report, async_eval)
+    sample = data.sample_padded if padded else data.sample
+    if max_steps is not None:
+        # Batches 0 to `iterations` are all trained on
+        iterations = min(iterations, max(max_steps, 1) - 1)
+
     for iteration in range(iterations + 1):
-        # Sample a bucket
-        bucket_id = np.random.choice(bucket_weights.shape[0], p=bucket_weights)
-        example_ids = train_buckets[bucket_id, 0] + np.random.choice(
-            train_buckets[bucket_id, 1] - train_buckets[bucket_id, 0],
-            size=batch_size)
+        yield sample(batch_size)
+        if iteration % 1000 == 0 and iteration < iterations:
+            if (monitor(model, iteration, True)
+                    and should_stop(stop_criterion, stats)):
+                break
 
-        yield encode(train_x[example_ids], train_y[example_ids])
-        if iteration % 1000 == 0:
-            monitor(iteration)
+    monitor.finish(model, iteration)
 
 class CartPoleEnv(object):
     # https://github.com/openai/gym/blob/master/gym/envs/classic_control/cartpole.py
@@ -487,12 +1159,33 @@ class ReplayMemory(object):
     def __init__(self, capacity):
         """Replay memory class
 
+        Transitions are stored column-wise (one array per `Transition` field),
+        so that a minibatch of any size is gathered with a single index per
+        column.
+
         Args:
             capacity (int): Max size of this memory
         """
         self.capacity = capacity
         self.cursor = 0
-        self.memory = []
+        self.size = 0
+        self.columns = None
+
+    def allocate(self, state_shape):
+        """Creates the storage columns once the state shape is known
+
+        Args:
+            state_shape (tuple): Shape of a single state
+
+        Returns:
+            Transition: One array per field, each with `capacity` rows
+        """
+        return Transition(
+            state=np.zeros((self.capacity,) + state_shape),
+            action=np.zeros(self.capacity, dtype=int),
+            reward=np.zeros(self.capacity),
+            next_state=np.zeros((self.capacity,) + state_shape),
+            done=np.zeros(self.capacity, dtype=bool))
 
     def push(self, state, action, reward, next_state, done):
         """Creates `Transition` and insert
@@ -504,11 +1197,26 @@ class ReplayMemory(object):
             next_state (np.ndarray): 1-D tensor of shape (input_dim,)
             done (bool): whether this state was last step
         """
-        if len(self) < self.capacity:
-            self.memory.append(None)
+        if self.columns is None:
+            self.columns = self.allocate(np.shape(state))
 
-        self.memory[self.cursor] = Transition(state, action, reward, next_state, done)
+        for column, value in zip(
+                self.columns, (state, action, reward, next_state, done)):
+            column[self.cursor] = value
         self.cursor = (self.cursor + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def pop_arrays(self, batch_size):
+        """Returns a minibatch of transitions randomly, as stacked arrays
+
+        Args:
+            batch_size (int): Size of mini-bach
+
+        Returns:
+            Transition: Each field is an array with `batch_size` rows
+        """
+        indices = random.sample(range(len(self)), batch_size)
+        return Transition(*[column[indices] for column in self.columns])
 
     def pop(self, batch_size):
         """Returns a minibatch of `Transition` randomly
@@ -519,30 +1227,230 @@ class ReplayMemory(object):
         Returns:
             List[Transition]: Minibatch of `Transition`
         """
-        return random.sample(self.memory, batch_size)
+        return [Transition(*row) for row in zip(*self.pop_arrays(batch_size))]
 
     def __len__(self):
         """Returns the length """
-        return len(self.memory)
+        return self.size
+
+class MemmapReplayMemory(ReplayMemory):
+    # Header layout: capacity, cursor, size, state_size
+    header_fields = 4
 
-def get_data_and_monitor_rl(model):
+    def __init__(self, capacity, path, mode="r+", state_size=None):
+        """Replay memory backed by `np.memmap` files in a directory
+
+        Each `Transition` field is stored in its own file, next to a small
+        header holding the cursor and size. Only the rows that are pushed or
+        sampled are paged in, so the capacity is limited by disk rather than
+        RAM. Opening an existing directory resumes from where it was left.
+        Other processes may open the same directory with mode="r" to sample
+        from it read-only while it is being filled.
+
+        Args:
+            capacity (int): Max size of this memory. When resuming, it must
+                match the stored capacity, unless it is None
+            path (str): Directory holding the memory-mapped files
+            mode (str): "r+" to create or resume, "r" to open read-only
+            state_size (int): Optional length of a state. When resuming, it
+                must match the stored state size
+        """
+        self.path = path
+        self.mode = mode
+        header_path = os.path.join(path, "header.bin")
+
+        if os.path.exists(header_path):
+            self.header = np.memmap(header_path, dtype=np.int64, mode=mode,
+                                    shape=(self.header_fields,))
+            self.capacity = int(self.header[0])
+            self.columns = None
+            if capacity is not None and capacity != self.capacity:
+                raise Exception(
+                    "Replay memory at {} has capacity {}, not {}".format(
+                        path, self.capacity, capacity))
+            if (state_size is not None and self.header[3] > 0
+                    and state_size != self.header[3]):
+                raise Exception(
+                    "Replay memory at {} has states of size {}, not {}".format(
+                        path, int(self.header[3]), state_size))
+            if self.header[3] > 0:
+                self.columns = self.open_columns((int(self.header[3]),), mode)
+        elif mode == "r":
+            raise Exception("No replay memory found at: {}".format(path))
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.header = np.memmap(header_path, dtype=np.int64, mode="w+",
+                                    shape=(self.header_fields,))
+            self.header[0] = capacity
+            self.capacity = capacity
+            self.columns = None
+
+    @property
+    def cursor(self):
+        return int(self.header[1])
+
+    @cursor.setter
+    def cursor(self, value):
+        self.header[1] = value
+
+    @property
+    def size(self):
+        return int(self.header[2])
+
+    @size.setter
+    def size(self, value):
+        self.header[2] = value
+
+    def open_columns(self, state_shape, mode):
+        """Maps one file per `Transition` field
+
+        Args:
+            state_shape (tuple): Shape of a single state
+            mode (str): Mode passed on to `np.memmap`
+
+        Returns:
+            Transition: One memory-mapped array per field
+        """
+        dtypes = Transition(np.float64, np.int64, np.float64, np.float64, bool)
+        shapes = Transition(
+            (self.capacity,) + state_shape, (self.capacity,), (self.capacity,),
+            (self.capacity,) + state_shape, (self.capacity,))
+        return Transition(*[
+            np.memmap(os.path.join(self.path, name + ".bin"), dtype=dtype,
+                      mode=mode, shape=shape)
+            for name, dtype, shape in zip(Transition._fields, dtypes, shapes)])
+
+    def pop_arrays(self, batch_size):
+        if self.columns is None and self.header[3] > 0:
+            # Opened read-only before the first push; the files exist now
+            self.columns = self.open_columns(
+                (int(self.header[3]),), self.mode)
+        return ReplayMemory.pop_arrays(self, batch_size)
+
+    def allocate(self, state_shape):
+        assert len(state_shape) == 1, "States must be 1-D tensors"
+        if self.mode == "r":
+            raise Exception("Replay memory at {} is read-only".format(self.path))
+        columns = self.open_columns(state_shape, "w+")
+        self.header[3] = state_shape[0]
+        return columns
+
+    def flush(self):
+        """Writes any pending changes to disk"""
+        self.header.flush()
+        if self.columns is not None:
+            for column in self.columns:
+                column.flush()
+
+def run_cartpole_actor(model, shared_params, params_version, episode_counter,
+                       stop_event, episodes_queue, seed, theta_threshold_degrees,
+                       max_eps_episode, min_eps, n_episode):
+    """Collects CartPole episodes in a worker process
+
+    Each episode is played epsilon-greedily with the most recently published
+    copy of the learner's parameters, and sent back as a single message.
+
+    Args:
+        model (DeepQModel): A copy of the model, used to select actions
+        shared_params (multiprocessing.Array): Flattened learner parameters
+        params_version (multiprocessing.Value): Bumped on every publish
+        episode_counter (multiprocessing.Value): Episodes started by all actors
+        stop_event (multiprocessing.Event): Set by the learner when finished
+        episodes_queue (multiprocessing.Queue): Receives
+            (eps, total_reward, (states, actions, rewards, next_states, dones))
+        seed (int): Seed for this actor's environment and exploration
+    """
+    np.random.seed(seed)
+    random.seed(seed)
+    env = CartPoleEnv(theta_threshold_degrees, seed=seed)
+    variables = model.get_variables()
+    annealing_slope = (min_eps - 1.0) / max_eps_episode
+    version = None
+
+    while not stop_event.is_set():
+        with episode_counter.get_lock():
+            episode = episode_counter.value
+            if episode >= n_episode:
+                break
+            episode_counter.value += 1
+
+        if params_version.value != version:
+            with shared_params.get_lock():
+                version = params_version.value
+                flat = np.frombuffer(shared_params.get_obj())
+                offset = 0
+                for variable in variables:
+                    variable.data = flat[
+                        offset:offset + variable.data.size].reshape(
+                            variable.data.shape).copy()
+                    offset += variable.data.size
+
+        eps = max(annealing_slope * episode + 1.0, min_eps)
+        transitions = ([], [], [], [], [])
+        s = env.reset()
+        done = False
+        total_reward = 0
+
+        while not done:
+            a = model.get_action(s[np.newaxis,:], eps)
+            s2, r, done, info = env.step(a)
+            total_reward += r
+            for column, value in zip(
+                    transitions, (s, a, r if not done else -1, s2, done)):
+                column.append(value)
+            s = s2
+
+        episodes_queue.put((eps, total_reward, transitions))
+
+def get_data_and_monitor_rl(model, target_update_interval=None,
+                            target_update_tau=None, double_dqn=False,
+                            num_actors=0, actor_sync_interval=50,
+                            train_every=1, gradient_steps=1, batch_size=64,
+                            replay_capacity=50000, replay_path=None,
+                            stop_criterion=None, max_steps=None):
+    """Runs DQN on CartPole, yielding (states, Q_target) minibatches
+
+    Args:
+        model (DeepQModel): The online Q-network being trained
+        target_update_interval (int): If set, bootstrap from a frozen copy of
+            the online network that is re-synced every this many gradient steps
+        target_update_tau (float): If set, bootstrap from a target network that
+            tracks the online network by Polyak averaging with this rate after
+            every gradient step. Takes precedence over `target_update_interval`
+        double_dqn (bool): Select the next action with the online network but
+            evaluate it with the target network. Without a target network this
+            is the same as the standard DQN target.
+        num_actors (int): If positive, collect experience in this many worker
+            processes (see `run_cartpole_actor`) while this process only
+            learns. The environment is not rendered in this mode.
+        actor_sync_interval (int): Number of gradient steps between publishing
+            the learner's parameters to the actors
+        train_every (int): Number of environment steps between training
+        gradient_steps (int): Number of minibatches to yield each time the
+            agent trains. The update-to-data ratio is
+            `gradient_steps / train_every`
+        batch_size (int): Number of transition samples in each minibatch
+        replay_capacity (int): Max size of the replay buffer
+        replay_path (str): If set, keep the replay buffer in memory-mapped
+            files in this directory (see `MemmapReplayMemory`), resuming from
+            any transitions already stored there
+        stop_criterion (StopCriterion): If set, consulted after every episode
+            once the mean reward is available
+        max_steps (int): If set, stop after this many minibatches, and set the
+            mean reward from greedy episodes played with the final parameters
+    """
     # Adapted from https://gist.github.com/kkweon/52ea1e118101eb574b2a83b933851379
     stats = {}
     set_stats(model, stats)
     stats['mean_reward'] = 0
 
-    # Max size of the replay buffer
-    capacity = 50000
-
     # After max episode, eps will be `min_eps`
     max_eps_episode = 50
 
     # eps will never go below this value
     min_eps = 0.01
 
-    # Number of transition samples in each minibatch update
-    batch_size = 64
-
     # Number of episodes between rendering the environment
     play_every = 10
 
@@ -570,74 +1478,55 @@ def get_data_and_monitor_rl(model):
     episode_print_interval = 10
 
     stats['reward_threshold'] = reward_threshold
+    if stop_criterion is not None:
+        stop_criterion.start()
+
+    # Frozen copy of the online parameters used to compute bootstrap targets
+    use_target_network = (
+        target_update_interval is not None or target_update_tau is not None)
+    variables = model.get_variables()
+    target_values = [np.copy(v.data) for v in variables]
 
     env = CartPoleEnv(theta_threshold_degrees, seed=seed)
     rewards = deque(maxlen=num_episodes_to_average)
     input_dim, output_dim = env.observation_state_size, env.num_actions
-    replay_memory = ReplayMemory(capacity)
-
-    cart_width = 1.0
-    cart_height = 0.1
-    pole_width = 0.05
-    pole_height = 2.0
-
-    def get_cart_coords(x):
-        return [
-            (x - cart_width / 2, -cart_height),
-            (x + cart_width / 2, -cart_height),
-            (x + cart_width / 2, cart_height),
-            (x - cart_width / 2, cart_height),
-        ]
-
-    def get_pole_coords(x, theta):
-        bottom_left = np.array([
-            x + pole_width * np.cos(np.pi - theta),
-            pole_width * np.sin(np.pi - theta)])
-        bottom_right = np.array([
-            x + pole_width * np.cos(-theta),
-            pole_width * np.sin(-theta)])
-        top_offset = np.array([
-            pole_height * np.cos(np.pi / 2 - theta),
-            pole_height * np.sin(np.pi / 2 - theta)])
-        return [
-            bottom_left,
-            bottom_right,
-            bottom_right + top_offset,
-            bottom_left + top_offset
-        ]
+    if replay_path is not None:
+        # The state size is read back from the files when resuming
+        replay_memory = MemmapReplayMemory(replay_capacity, replay_path)
+    else:
+        replay_memory = ReplayMemory(replay_capacity)
 
-    if use_graphics:
-        import matplotlib.patches as patches
-        fig, ax = plt.subplots(1, 1)
-        ax.set_xlim(-env.x_threshold - cart_width, env.x_threshold + cart_width)
-        ax.set_ylim(-cart_height / 2, pole_height * 1.1)
-        ax.set_aspect("equal")
-        cart_polygon = patches.Polygon(get_cart_coords(0), color="black")
-        pole_polygon = patches.Polygon(get_pole_coords(0, 0), color="blue")
-        ax.add_patch(pole_polygon)
-        ax.add_patch(cart_polygon)
-        text = ax.text(0.02, 0.95, "", transform=ax.transAxes, va="top")
-        plt.show(block=False)
+    if use_graphics and num_actors == 0:
+        renderer = Renderer(cartpole_view, env.x_threshold, n_episode)
 
     def train_helper(minibatch):
         """Prepare minibatches
 
         Args:
-            minibatch (List[Transition]): Minibatch of `Transition`
+            minibatch (Transition): Minibatch of stacked transition arrays
 
         Returns:
             float: Loss value
         """
-        states = np.vstack([x.state for x in minibatch])
-        actions = np.array([x.action for x in minibatch])
-        rewards = np.array([x.reward for x in minibatch])
-        next_states = np.vstack([x.next_state for x in minibatch])
-        done = np.array([x.done for x in minibatch])
+        states, actions, rewards, next_states, done = minibatch
 
         Q_predict = model.run(states)
         Q_target = np.copy(Q_predict)
+
+        if use_target_network:
+            with swapped_parameters(variables, target_values):
+                Q_next = model.run(next_states)
+        else:
+            Q_next = model.run(next_states)
+
+        if double_dqn and use_target_network:
+            next_actions = np.argmax(model.run(next_states), axis=1)
+            next_values = Q_next[np.arange(len(Q_next)), next_actions]
+        else:
+            next_values = np.max(Q_next, axis=1)
+
         Q_target[np.arange(len(Q_target)), actions] = (
-            rewards + gamma * np.max(model.run(next_states), axis=1) * ~done)
+            rewards + gamma * next_values * ~done)
 
         if td_error_clipping is not None:
             Q_target = Q_predict + np.clip(
@@ -648,41 +1537,18 @@ def get_data_and_monitor_rl(model):
 
         return Q_predict, Q_target
 
-    annealing_slope = (min_eps - 1.0) / max_eps_episode
-
-    for episode in range(n_episode):
-        eps = max(annealing_slope * episode + 1.0, min_eps)
-        render = play_every != 0 and (episode + 1) % play_every == 0
-
-        s = env.reset()
-        done = False
-        total_reward = 0
-
-        while not done:
-            a = model.get_action(s[np.newaxis,:], eps)
-            s2, r, done, info = env.step(a)
-
-            total_reward += r
-
-            if render and use_graphics:
-                x, x_dot, theta, theta_dot = env.state
-                cart_polygon.set_xy(get_cart_coords(x))
-                pole_polygon.set_xy(get_pole_coords(x, theta))
-                text.set_text("episode: {:,}/{:,}\nreward: {}".format(
-                    episode + 1, n_episode, total_reward))
-                fig.canvas.draw_idle()
-                fig.canvas.start_event_loop(1e-3)
-
-            replay_memory.push(s, a, r if not done else -1, s2, done)
-
-            if len(replay_memory) > batch_size:
-                minibatch = replay_memory.pop(batch_size)
-                Q_predict, Q_target = train_helper(minibatch)
-                states = np.vstack([x.state for x in minibatch])
-                yield states, Q_target
-
-            s = s2
-
+    def update_target_network(num_steps):
+        if target_update_tau is not None:
+            for target, variable in zip(target_values, variables):
+                target *= 1.0 - target_update_tau
+                target += target_update_tau * variable.data
+        elif target_update_interval is not None:
+            if num_steps % target_update_interval == 0:
+                for target, variable in zip(target_values, variables):
+                    target[...] = variable.data
+
+    def finish_episode(episode, total_reward, eps):
+        """Records a finished episode, returning True once the agent has won"""
         rewards.append(total_reward)
         if (episode + 1) % episode_print_interval == 0:
             print("[Episode: {:3}] Reward: {:5} Mean Reward of last {} episodes: {:5.1f} epsilon: {:5.2f}".format(
@@ -690,20 +1556,186 @@ def get_data_and_monitor_rl(model):
 
         if len(rewards) == rewards.maxlen:
             stats['mean_reward'] = np.mean(rewards)
+            count_evaluation(stats)
             if np.mean(rewards) >= reward_threshold:
                 print("Completed in {} episodes with mean reward {}".format(
                     episode + 1, np.mean(rewards)))
                 stats['reward_threshold_met'] = True
-                break
-    else:
-        # reward threshold not met
-        print("Aborted after {} episodes with mean reward {}".format(
-            episode + 1, np.mean(rewards)))
+                return True
+            if should_stop(stop_criterion, stats):
+                return True
+        return False
+
+    def train_step():
+        minibatch = replay_memory.pop_arrays(batch_size)
+        Q_predict, Q_target = train_helper(minibatch)
+        return minibatch.state, Q_target
+
+    def steps_exhausted():
+        return max_steps is not None and num_steps >= max_steps
+
+    def evaluate_greedy():
+        """Replaces the mean reward, which may predate the last minibatches"""
+        eval_env = CartPoleEnv(theta_threshold_degrees, seed=seed)
+        eval_rewards = []
+        for _ in range(num_episodes_to_average):
+            s = eval_env.reset()
+            done = False
+            total_reward = 0
+            while not done:
+                s, r, done, info = eval_env.step(
+                    model.get_action(s[np.newaxis,:], 0.0))
+                total_reward += r
+            eval_rewards.append(total_reward)
+        stats['mean_reward'] = np.mean(eval_rewards)
+        count_evaluation(stats)
+        print("Stopped after {} steps with greedy mean reward {}".format(
+            num_steps, stats['mean_reward']))
+
+    annealing_slope = (min_eps - 1.0) / max_eps_episode
+    num_steps = 0
+    num_env_steps = 0
+    episode = 0
+
+    if num_actors > 0:
+        # Actor/learner split: worker processes step their own environments
+        # with a periodically refreshed copy of the parameters, while this
+        # process trains on every transition they send back.
+        shared_params = multiprocessing.Array(
+            'd', int(sum(v.data.size for v in variables)))
+        params_version = multiprocessing.Value('i', 0)
+        episode_counter = multiprocessing.Value('i', 0)
+        stop_event = multiprocessing.Event()
+        episodes_queue = multiprocessing.Queue(maxsize=4 * num_actors)
+
+        def publish_parameters():
+            with shared_params.get_lock():
+                flat = np.frombuffer(shared_params.get_obj())
+                offset = 0
+                for variable in variables:
+                    flat[offset:offset + variable.data.size] = variable.data.ravel()
+                    offset += variable.data.size
+                params_version.value += 1
+
+        publish_parameters()
+        actors = [
+            multiprocessing.Process(target=run_cartpole_actor, args=(
+                model, shared_params, params_version, episode_counter,
+                stop_event, episodes_queue, seed + actor_id + 1,
+                theta_threshold_degrees, max_eps_episode, min_eps, n_episode))
+            for actor_id in range(num_actors)]
+        for actor in actors:
+            actor.daemon = True
+            actor.start()
 
-    if use_graphics:
-        plt.close(fig)
         try:
-            # This raises a TclError on some Windows machines
-            fig.canvas.start_event_loop(1e-3)
-        except:
-            pass
+            completed = 0
+            # Gradient steps owed for received transitions, so that the learner
+            # does at least one step per environment step like the serial loop
+            steps_owed = 0
+            while completed < n_episode:
+                message = None
+                block = len(replay_memory) <= batch_size
+                if steps_owed <= 0 or block:
+                    # Block for experience only while there is too little to
+                    # train on; otherwise keep training while actors play
+                    try:
+                        if block:
+                            message = episodes_queue.get(timeout=1.0)
+                        else:
+                            message = episodes_queue.get_nowait()
+                    except queue.Empty:
+                        if block and not any(a.is_alive() for a in actors):
+                            print("Aborted after {} episodes with mean reward {}: "
+                                  "every actor has exited".format(
+                                      completed, stats['mean_reward']))
+                            break
+
+                if message is not None:
+                    eps, total_reward, transitions = message
+                    for transition in zip(*transitions):
+                        replay_memory.push(*transition)
+                    steps_owed += (
+                        len(transitions[0]) * gradient_steps / float(train_every))
+                    episode = completed
+                    completed += 1
+                    if finish_episode(episode, total_reward, eps):
+                        break
+
+                if len(replay_memory) > batch_size:
+                    yield train_step()
+                    num_steps += 1
+                    steps_owed -= 1
+                    if use_target_network:
+                        update_target_network(num_steps)
+                    if steps_exhausted():
+                        break
+                    if num_steps % actor_sync_interval == 0:
+                        publish_parameters()
+            else:
+                print("Aborted after {} episodes with mean reward {}".format(
+                    completed, np.mean(rewards)))
+        finally:
+            if replay_path is not None:
+                replay_memory.flush()
+            stop_event.set()
+            for actor in actors:
+                actor.join(timeout=1.0)
+                if actor.is_alive():
+                    actor.terminate()
+        if steps_exhausted():
+            evaluate_greedy()
+        return
+
+    try:
+        for episode in range(n_episode):
+            eps = max(annealing_slope * episode + 1.0, min_eps)
+            render = play_every != 0 and (episode + 1) % play_every == 0
+
+            s = env.reset()
+            done = False
+            total_reward = 0
+
+            while not done:
+                a = model.get_action(s[np.newaxis,:], eps)
+                s2, r, done, info = env.step(a)
+
+                total_reward += r
+
+                if render and use_graphics:
+                    x, x_dot, theta, theta_dot = env.state
+                    renderer.draw((episode + 1, x, theta, total_reward))
+
+                replay_memory.push(s, a, r if not done else -1, s2, done)
+                num_env_steps += 1
+
+                if (len(replay_memory) > batch_size
+                        and num_env_steps % train_every == 0):
+                    for _ in range(gradient_steps):
+                        yield train_step()
+                        num_steps += 1
+                        if use_target_network:
+                            update_target_network(num_steps)
+                        if steps_exhausted():
+                            break
+
+                s = s2
+                if steps_exhausted():
+                    break
+
+            if steps_exhausted():
+                evaluate_greedy()
+                break
+            if finish_episode(episode, total_reward, eps):
+                break
+        else:
+            # reward threshold not met
+            print("Aborted after {} episodes with mean reward {}".format(
+                episode + 1, np.mean(rewards)))
+    finally:
+        if replay_path is not None:
+            replay_memory.flush()
+
+    if use_graphics and num_actors == 0:
+        renderer.flush()
+        renderer.close()
@@ -0,0 +1,464 @@
+# Performance benchmarks for this project
+
+################################################################################
+# A mini-framework for benchmarking
+################################################################################
+
+import collections
+import contextlib
+import json
+import optparse
+import os
+import random
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy as np
+
+SUITES = []
+
+def suite(name):
+    def deco(fn):
+        SUITES.append((name, fn))
+        return fn
+    return deco
+
+def parse_options(argv):
+    parser = optparse.OptionParser(
+        usage = '%prog [options] [suite ...]',
+        description = 'Run performance benchmarks. Runs every suite if none are named: {}'.format(
+            ', '.join(name for name, fn in SUITES)))
+    parser.add_option('--repeats', '-r',
+                        dest = 'repeats',
+                        type = 'int',
+                        default = 5,
+                        help = 'Number of times to repeat each measurement (default %default)')
+    parser.add_option('--max-import-time',
+                        dest = 'max_import_time',
+                        type = 'float',
+                        default = 0.5,
+                        help = 'Fail if the median cold-start import time exceeds this many seconds (default %default)')
+    parser.add_option('--workers',
+                        dest = 'workers',
+                        default = '1,2,4',
+                        help = 'Comma-separated worker counts for parallel training (default %default)')
+    parser.add_option('--iterations',
+                        dest = 'iterations',
+                        type = 'int',
+                        default = 3000,
+                        help = 'Training steps per run for parallel training (default %default)')
+    parser.add_option('--models',
+                        dest = 'models',
+                        default = ','.join(MODELS),
+                        help = 'Comma-separated models to benchmark (default %default)')
+    parser.add_option('--max-steps',
+                        dest = 'max_steps',
+                        type = 'int',
+                        default = None,
+                        help = 'Cap on training steps per model (default: train until the grading threshold or the end)')
+    parser.add_option('--seed',
+                        dest = 'seed',
+                        type = 'int',
+                        default = 0,
+                        help = 'Seed for every benchmarked training run (default %default)')
+    parser.add_option('--json',
+                        dest = 'json',
+                        default = None,
+                        help = 'Write the model results to this JSON file')
+    parser.add_option('--baseline',
+                        dest = 'baseline',
+                        default = None,
+                        help = 'Compare the model results against this JSON file from an earlier --json run')
+    parser.add_option('--tolerance',
+                        dest = 'tolerance',
+                        type = 'float',
+                        default = 0.2,
+                        help = 'Fail if a model is this fraction slower or larger than the baseline (default %default)')
+    parser.add_option('--nodes',
+                        dest = 'nodes',
+                        default = ','.join(NODES),
+                        help = 'Comma-separated nn nodes to time (default %default)')
+    parser.add_option('--batch-sizes',
+                        dest = 'batch_sizes',
+                        default = '1,16,64,200',
+                        help = 'Comma-separated batch sizes for node timings (default %default)')
+    parser.add_option('--dtypes',
+                        dest = 'dtypes',
+                        default = 'float64,float32',
+                        help = 'Comma-separated dtypes for node timings (default %default)')
+    (options, args) = parser.parse_args(argv[1:])
+    return options, args
+
+def main():
+    options, names = parse_options(sys.argv)
+    suites = dict(SUITES)
+    for name in names:
+        if name not in suites:
+            print("ERROR: suite {} does not exist".format(name))
+            sys.exit(1)
+    if not names:
+        names = [name for name, fn in SUITES]
+
+    failures = []
+    for name in names:
+        text = 'Suite {}'.format(name)
+        print('\n' + text)
+        print('=' * len(text))
+        failures.extend(suites[name](options))
+
+    print()
+    if failures:
+        for failure in failures:
+            print("FAILED: {}".format(failure))
+        sys.exit(1)
+    print("All benchmarks passed")
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def run_python(code):
+    """Runs `code` in a fresh interpreter next to this file, returning stdout"""
+    return subprocess.check_output(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        universal_newlines=True)
+
+################################################################################
+# Benchmarks begin here
+################################################################################
+
+# Modules that a headless run should never pay for
+HEAVY_MODULES = ['matplotlib']
+
+IMPORT_CODE = """
+import sys, time
+start = time.perf_counter()
+import nn, models, backend
+print(time.perf_counter() - start)
+print(' '.join(name for name in {} if name in sys.modules))
+"""
+
+@suite('imports')
+def check_import_time(options):
+    """Guards the cold-start time of `import nn, models, backend`"""
+    failures = []
+    times = []
+    for _ in range(options.repeats):
+        output = run_python(IMPORT_CODE.format(HEAVY_MODULES)).splitlines()
+        times.append(float(output[0]))
+        heavy = output[1].split() if len(output) > 1 else []
+    print("import nn, models, backend: median {:.3f}s min {:.3f}s over {} runs".format(
+        median(times), min(times), len(times)))
+
+    if heavy:
+        failures.append("importing nn, models, backend also imported {}".format(
+            ', '.join(heavy)))
+    if median(times) > options.max_import_time:
+        failures.append("cold-start import took {:.3f}s, more than {:.3f}s".format(
+            median(times), options.max_import_time))
+    return failures
+
+@suite('hogwild')
+def check_hogwild(options):
+    """Reports language ID throughput and accuracy for each worker count"""
+    import backend, models
+    backend.use_graphics = False
+
+    batch_size = 16
+    results = []
+    for num_workers in [int(n) for n in options.workers.split(',')]:
+        np.random.seed(0)
+        model = models.LanguageIDModel()
+        model.train(num_workers=num_workers, hogwild=True,
+                    iterations=options.iterations, batch_size=batch_size,
+                    seed=0, log_interval=options.iterations)
+        results.append((num_workers, backend.get_stats(model)))
+
+    print()
+    print("{:>7} {:>10} {:>12} {:>12}".format(
+        'workers', 'steps/s', 'examples/s', 'accuracy'))
+    for num_workers, stats in results:
+        print("{:>7} {:>10.1f} {:>12.1f} {:>12.1%}".format(
+            num_workers, stats['steps'] / stats['seconds'],
+            stats['steps'] * batch_size / stats['seconds'],
+            stats['dev_accuracy']))
+    return []
+
+# Grading thresholds from autograder.py, as (stat, target, mode)
+MODELS = collections.OrderedDict([
+    ('Perceptron', ('accuracy', 1.0, 'max')),
+    ('RegressionModel', ('loss', 0.02, 'min')),
+    ('OddRegressionModel', ('loss', 0.02, 'min')),
+    ('DigitClassificationModel', ('dev_accuracy', 0.97, 'max')),
+    ('DeepQModel', ('reward_threshold_met', True, 'max')),
+    ('LanguageIDModel', ('dev_accuracy', 0.81, 'max')),
+])
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+
+def measure_model(name, max_steps, seed):
+    """
+    Trains one model headless and prints a JSON line of measurements. This is
+    run in a fresh interpreter per model so that peak RSS is the model's own.
+    """
+    import backend, models, perceptron
+    backend.use_graphics = False
+    np.random.seed(seed)
+    random.seed(seed)
+
+    metric, target, mode = MODELS[name]
+    if name == 'Perceptron':
+        model = perceptron.Perceptron(3)
+        train_options = {}
+    else:
+        model = getattr(models, name)()
+        train_options = {'stop_criterion': backend.StopCriterion(
+            metric, target=target, mode=mode)}
+
+    # Count the steps and examples that get_data_and_monitor hands out, and
+    # note when the model first reaches the grading threshold
+    counts = {'steps': 0, 'examples': 0, 'time_to_target': None}
+    get_data_and_monitor = model.get_data_and_monitor
+
+    def counting_get_data_and_monitor(model, **options):
+        for x, y in get_data_and_monitor(model, **options):
+            if max_steps is not None and counts['steps'] >= max_steps:
+                return
+            counts['steps'] += 1
+            counts['examples'] += len(np.atleast_1d(y))
+            check_target()
+            yield x, y
+
+    def check_target():
+        stats = backend.get_stats(model) or {}
+        value = stats.get(metric)
+        if counts['time_to_target'] is None and value is not None and (
+                value <= target if mode == 'min' else value >= target):
+            counts['time_to_target'] = time.time() - start
+
+    model.get_data_and_monitor = counting_get_data_and_monitor
+    start = time.time()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        model.train(**train_options)
+    seconds = time.time() - start
+    check_target()
+
+    print(json.dumps({
+        'steps': counts['steps'],
+        'examples': counts['examples'],
+        'seconds': seconds,
+        'steps_per_sec': counts['steps'] / seconds,
+        'examples_per_sec': counts['examples'] / seconds,
+        'time_to_target': counts['time_to_target'],
+        'peak_rss_mb': peak_rss_mb(),
+    }))
+
+MODEL_CODE = """
+import benchmark
+benchmark.measure_model({!r}, {!r}, {!r})
+"""
+
+def compare(name, result, baseline, tolerance):
+    """Lists the ways `result` is worse than `baseline` by more than `tolerance`"""
+    failures = []
+    for key, higher_is_better in [('steps_per_sec', True),
+                                  ('time_to_target', False),
+                                  ('peak_rss_mb', False)]:
+        old, new = baseline.get(key), result.get(key)
+        if old is None:
+            continue
+        if new is None:
+            failures.append("{}: {} is missing, baseline {:.4g}".format(name, key, old))
+        elif higher_is_better and new < old * (1 - tolerance):
+            failures.append("{}: {} fell from {:.4g} to {:.4g}".format(name, key, old, new))
+        elif not higher_is_better and new > old * (1 + tolerance):
+            failures.append("{}: {} rose from {:.4g} to {:.4g}".format(name, key, old, new))
+    return failures
+
+@suite('models')
+def check_models(options):
+    """Reports throughput, time to the grading threshold and memory per model"""
+    results = collections.OrderedDict()
+    failures = []
+    for name in options.models.split(','):
+        if name not in MODELS:
+            failures.append("unknown model {}".format(name))
+            continue
+        try:
+            output = run_python(MODEL_CODE.format(name, options.max_steps, options.seed))
+        except subprocess.CalledProcessError as e:
+            print("{}: training failed with exit status {}".format(name, e.returncode))
+            failures.append("{} could not be benchmarked".format(name))
+            continue
+        results[name] = json.loads(output.splitlines()[-1])
+
+    print("{:<26} {:>8} {:>10} {:>12} {:>10} {:>9}".format(
+        'model', 'steps', 'steps/s', 'examples/s', 'target(s)', 'RSS(MB)'))
+    for name, result in results.items():
+        print("{:<26} {:>8,} {:>10.1f} {:>12.1f} {:>10} {:>9}".format(
+            name, result['steps'], result['steps_per_sec'],
+            result['examples_per_sec'],
+            '-' if result['time_to_target'] is None
+            else '{:.2f}'.format(result['time_to_target']),
+            '-' if result['peak_rss_mb'] is None
+            else '{:.1f}'.format(result['peak_rss_mb'])))
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Results written to {}".format(options.json))
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        for name, result in results.items():
+            if name in baseline:
+                failures.extend(compare(
+                    name, result, baseline[name], options.tolerance))
+    return failures
+
+# (input, output) widths of every fully-connected layer in models.py
+LAYERS = [(1, 200), (200, 1), (784, 200), (200, 10), (4, 200), (200, 2),
+          (47, 200), (200, 200), (200, 5)]
+WIDTHS = sorted(set(width for layer in LAYERS for width in layer))
+CLASSES = [2, 5, 10]
+
+def node_cases(name, batch_size, dtype, random_state):
+    """
+    Yields (label, inputs, (forward flops, backward flops)) for every shape of
+    the node used by the models. Flop counts are approximate for everything
+    but MatrixMultiply, and count one flop per add, multiply or comparison.
+    """
+    def array(*shape):
+        return random_state.randn(*shape).astype(dtype)
+
+    n = batch_size
+    if name == 'MatrixMultiply':
+        for m, k in LAYERS:
+            yield ('{}x{} @ {}x{}'.format(n, m, m, k), [array(n, m), array(m, k)],
+                   (2 * n * m * k, 4 * n * m * k))
+    elif name == 'MatrixVectorAdd':
+        for k in WIDTHS:
+            yield '{}x{} + {}'.format(n, k, k), [array(n, k), array(k)], (n * k, n * k)
+    elif name in ('Add', 'ReLU'):
+        for k in WIDTHS:
+            inputs = [array(n, k), array(n, k)] if name == 'Add' else [array(n, k)]
+            yield '{}x{}'.format(n, k), inputs, (n * k, n * k if name == 'ReLU' else 0)
+    elif name == 'SquareLoss':
+        for k in WIDTHS:
+            yield '{}x{}'.format(n, k), [array(n, k), array(n, k)], (3 * n * k, 6 * n * k)
+    elif name == 'SoftmaxLoss':
+        for c in CLASSES:
+            labels = np.eye(c, dtype=dtype)[random_state.randint(c, size=n)]
+            yield '{}x{}'.format(n, c), [array(n, c), labels], (6 * n * c, 5 * n * c)
+
+NODES = ['Add', 'MatrixMultiply', 'MatrixVectorAdd', 'ReLU', 'SquareLoss',
+         'SoftmaxLoss']
+
+def time_call(fn, repeats):
+    """Returns the best time for one call to `fn`, in seconds"""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeats, number)) / number
+
+def node_passes(nn, cls, inputs, gradient):
+    """
+    Yields (pass, path, function) for the forward and backward passes of a
+    node. The 'alloc' path calls the kernels with out=None and, for backward,
+    stores each result in a new accumulator. The 'out' path does what Graph
+    does: kernels write into buffers from nn.buffer_pool, results that are
+    not written to their buffer are copied in, and the buffers are returned
+    to the pool.
+    """
+    pool = nn.buffer_pool
+
+    def allocate(shape, dtype):
+        dtype = np.dtype(dtype)
+        if pool is None or np.prod(shape) * dtype.itemsize < pool.min_bytes:
+            return np.empty(shape, dtype)
+        return pool.get(shape, dtype)
+
+    def free(arrays):
+        if pool is not None:
+            pool.put([array for array in arrays
+                      if array.nbytes >= pool.min_bytes])
+
+    dtype = np.result_type(*inputs)
+    shape = cls.output_shape(inputs)
+
+    def forward_out():
+        out = allocate(shape, dtype)
+        cls.forward(inputs, out=out)
+        free([out])
+
+    def backward_alloc():
+        return [np.array(result) for result in cls.backward(inputs, gradient)]
+
+    def backward_out():
+        out = [allocate(np.shape(x), dtype) for x in inputs]
+        for buffer, result in zip(out, cls.backward(inputs, gradient, out=out)):
+            if result is not buffer:
+                np.copyto(buffer, result)
+        free(out)
+
+    yield 'forward', 'alloc', lambda: cls.forward(inputs)
+    if shape is not None:
+        yield 'forward', 'out', forward_out
+    yield 'backward', 'alloc', backward_alloc
+    yield 'backward', 'out', backward_out
+
+@suite('nodes')
+def check_nodes(options):
+    """
+    Times forward and backward of each nn node over the models' shapes, both
+    allocating their outputs and writing into pooled buffers as Graph does
+    """
+    import nn
+
+    random_state = np.random.RandomState(options.seed)
+    print("{:<16} {:<8} {:<6} {:<18} {:<8} {:>10} {:>10} {:>9} {:>8}".format(
+        'node', 'pass', 'path', 'shape', 'dtype', 'time(us)', 'ns/elem',
+        'GFLOP/s', 'speedup'))
+    for name in options.nodes.split(','):
+        cls = getattr(nn, name)
+        for dtype in options.dtypes.split(','):
+            for batch_size in [int(n) for n in options.batch_sizes.split(',')]:
+                for label, inputs, flops in node_cases(
+                        name, batch_size, np.dtype(dtype), random_state):
+                    output = cls.forward(inputs)
+                    gradient = (1.0 if np.ndim(output) == 0
+                                else np.ones_like(output))
+                    elements = sum(x.size for x in inputs)
+                    alloc_seconds = {}
+                    for pass_name, path, fn in node_passes(
+                            nn, cls, inputs, gradient):
+                        seconds = time_call(fn, options.repeats)
+                        pass_flops = flops[pass_name == 'backward']
+                        if path == 'alloc':
+                            alloc_seconds[pass_name] = seconds
+                            speedup = '-'
+                        else:
+                            speedup = '{:.2f}x'.format(
+                                alloc_seconds[pass_name] / seconds)
+                        print("{:<16} {:<8} {:<6} {:<18} {:<8} {:>10.2f} {:>10.3f} {:>9} {:>8}".format(
+                            name, pass_name, path, label, dtype, seconds * 1e6,
+                            seconds * 1e9 / elements,
+                            '{:.3f}'.format(pass_flops / seconds / 1e9)
+                            if pass_flops else '-', speedup))
+    return []
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,12 @@
+import threading
+import weakref
+
 import numpy as np
 
+# Temporary arrays for Graph.backprop and Graph.step, shared by all graphs in
+# a thread. See `Graph.get_scratch`.
+scratch = threading.local()
+
 def main():
     """
     This is sample code for linear regression, which demonstrates how to use the
@@ -44,6 +51,96 @@ def main():
     assert np.isclose(b.data[0], 3)
     print("Success!")
 
+class BufferPool(object):
+    """
+    Recycles the output and gradient arrays of discarded Graphs.
+
+    Free arrays are kept in lists keyed by (shape, dtype). Every Graph takes
+    its buffers from the module's `buffer_pool`, and hands them back when it is
+    garbage collected, or earlier for buffers it no longer needs. Arrays that
+    a Graph returns to its caller, through `get_output`, `get_inputs` or
+    `get_gradient`, may be kept by the caller, so they leave the pool for good.
+
+    Since training builds graphs of the same shapes over and over, nearly
+    every request is served from the free lists after the first few steps.
+    Small arrays are cheaper to allocate than to track, so Graphs only pool
+    arrays of at least `min_bytes`.
+    """
+
+    def __init__(self, min_bytes=2**16, max_free_bytes=2**28):
+        """
+        min_bytes: the size of the smallest arrays Graphs take from the pool
+        max_free_bytes: arrays handed back while the free lists hold this
+            many bytes are left to the garbage collector instead
+        """
+        self.min_bytes = min_bytes
+        self.max_free_bytes = max_free_bytes
+        self.free = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hits = 0
+        self.bytes_in_use = 0
+        self.bytes_free = 0
+        self.bytes_allocated = 0
+
+    def get(self, shape, dtype):
+        """Returns an array with unspecified contents"""
+        key = (tuple(shape), np.dtype(dtype))
+        with self.lock:
+            self.requests += 1
+            buffers = self.free.get(key)
+            if buffers:
+                self.hits += 1
+                array = buffers.pop()
+                self.bytes_free -= array.nbytes
+                self.bytes_in_use += array.nbytes
+                return array
+        array = np.empty(key[0], key[1])
+        with self.lock:
+            self.bytes_allocated += array.nbytes
+            self.bytes_in_use += array.nbytes
+        return array
+
+    def put(self, arrays):
+        """Takes back arrays from `get`, which must no longer be used"""
+        with self.lock:
+            for array in arrays:
+                self.bytes_in_use -= array.nbytes
+                if self.bytes_free + array.nbytes <= self.max_free_bytes:
+                    self.free.setdefault(
+                        (array.shape, array.dtype), []).append(array)
+                    self.bytes_free += array.nbytes
+
+    def forget(self, array):
+        """Stops counting an array from `get` that will never be put back"""
+        with self.lock:
+            self.bytes_in_use -= array.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.free = {}
+            self.bytes_free = 0
+
+    def get_stats(self):
+        """
+        Returns a dict with the number of `requests`, the number of `hits`
+        served from the free lists and their ratio `hit_rate`, the bytes held
+        by live graphs (`bytes_in_use`) and by the free lists (`bytes_free`),
+        and the total bytes of new arrays allocated (`bytes_allocated`).
+        """
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'hits': self.hits,
+                'hit_rate': self.hits / float(max(self.requests, 1)),
+                'bytes_in_use': self.bytes_in_use,
+                'bytes_free': self.bytes_free,
+                'bytes_allocated': self.bytes_allocated,
+            }
+
+# The pool used by new Graphs; set to None to allocate every array afresh
+buffer_pool = BufferPool()
+
 class Graph(object):
     """
     A graph that keeps track of the computations performed by a neural network
@@ -64,12 +161,21 @@ class Graph(object):
     For an example of how the Graph can be used, see the function `main` above.
     """
 
-    def __init__(self, variables):
+    def __init__(self, variables, checkpoint_every=None):
         """
         Initializes a new computation graph.
 
         variables: a list of Variable objects that store the trainable parameters
             for the neural network.
+        checkpoint_every: if set to k, only the output of every k-th
+            FunctionNode (a checkpoint) is kept for the whole life of the
+            graph. Other outputs are dropped once two more checkpoints have been
+            added after them, and recomputed from the preceding checkpoint
+            when they are needed again, e.g. during backprop. This trades
+            about one extra forward pass for memory that grows with the number
+            of checkpoints instead of the number of nodes, which pays off for
+            long unrolled graphs. Gradients take as much memory as outputs, so
+            train with `backprop_and_step` to bound both.
 
         Hint: each Variable is also a node that needs to be added to the graph,
         so don't forget to call `self.add` on each of the variables.
@@ -79,6 +185,26 @@ class Graph(object):
         self.nodes = {}
         self.mynodes =[]
         self.nodeGradients = {}
+        # Nodes whose gradients `backprop_and_step` has dropped
+        self.released = set()
+
+        self.checkpoint_every = checkpoint_every
+        self.checkpoints = set()
+        # For each node whose output may be dropped, the position in
+        # `mynodes` from which to recompute it
+        self.recompute_from = {}
+        # Non-checkpoint FunctionNodes added since the last two checkpoints
+        self.segment = []
+        self.previous_segment = []
+        self.segment_start = 0
+        self.num_functions = 0
+
+        # Arrays taken from the pool, by id, which go back to it when the
+        # graph is garbage collected
+        self.pool = buffer_pool
+        self.owned = {}
+        if self.pool is not None:
+            weakref.finalize(self, release_buffers, self.pool, self.owned)
         for node in variables:
             self.add(node)
 
@@ -107,6 +233,10 @@ class Graph(object):
             result.append(self.get_output(parent))
         return result
 
+    def inputs_of(self, node):
+        # Like get_inputs, but the arrays stay owned by the graph
+        return [self.output_of(parent) for parent in node.get_parents()]
+
     def get_output(self, node):
         """
         Retrieves the output to a node in the graph. Assume the `node` has
@@ -115,8 +245,75 @@ class Graph(object):
         Returns: a numpy array or a scalar
         """
         "*** YOUR CODE HERE ***"
+        return self.escape(self.output_of(node))
+
+    def output_of(self, node):
+        # Like get_output, but the array stays owned by the graph
+        if node not in self.nodes:
+            self.recompute(node)
         return self.nodes[node]
 
+    def compute(self, node):
+        """
+        Runs the forward pass of `node`, into a pooled buffer if the node can
+        tell the shape of its output in advance.
+        """
+        inputs = self.inputs_of(node)
+        if not node.get_parents():
+            return node.forward(inputs)
+        shape = node.output_shape(inputs)
+        if shape is None:
+            return node.forward(inputs)
+        out = self.allocate(shape, np.result_type(*inputs))
+        output = node.forward(inputs, out=out)
+        if output is not out:
+            self.free(out)
+            # The output may be a view of an input, which must then outlive
+            # its node
+            self.escape(output)
+        return output
+
+    def recompute(self, node):
+        """
+        Recomputes the dropped outputs from the checkpoint before `node` up to
+        `node` itself. They are kept until backprop passes them again.
+        """
+        end = self.mynodes.index(node, self.recompute_from[node])
+        for other in self.mynodes[self.recompute_from[node]:end + 1]:
+            if other not in self.nodes:
+                self.nodes[other] = self.compute(other)
+
+    def drop_output(self, node):
+        if node in self.nodes and node not in self.checkpoints:
+            self.free(self.nodes.pop(node))
+
+    def allocate(self, shape, dtype):
+        # An array with unspecified contents, from the pool if there is one
+        dtype = np.dtype(dtype)
+        if (self.pool is None or
+                np.prod(shape) * dtype.itemsize < self.pool.min_bytes):
+            return np.empty(shape, dtype)
+        array = self.pool.get(shape, dtype)
+        self.owned[id(array)] = array
+        return array
+
+    def free(self, array):
+        # Hands an array back to the pool, unless the graph does not own it
+        if self.owned.pop(id(array), None) is not None:
+            self.pool.put([array])
+
+    def escape(self, array):
+        """
+        Marks an array, and any array it is a view of, as no longer owned by
+        the graph, since the caller may hold on to it. Returns the array.
+        """
+        base = array
+        while base is not None and self.owned:
+            if self.owned.pop(id(base), None) is not None:
+                self.pool.forget(base)
+            base = getattr(base, 'base', None)
+        return array
+
     def get_gradient(self, node):
         """
         Retrieves the gradient for a node in the graph. Assume the `node` has
@@ -131,6 +328,16 @@ class Graph(object):
         Returns: a numpy array
         """
         "*** YOUR CODE HERE ***"
+        assert node not in self.released, \
+            "The gradient of this node was released by Graph.backprop_and_step"
+        return self.escape(self.gradient_of(node))
+
+    def gradient_of(self, node):
+        # Like get_gradient, but the array stays owned by the graph
+        if node not in self.nodeGradients:
+            output = np.asarray(self.output_of(node))
+            self.nodeGradients[node] = self.allocate(output.shape, output.dtype)
+            self.nodeGradients[node].fill(0)
         return self.nodeGradients[node]
 
     def add(self, node):
@@ -146,10 +353,45 @@ class Graph(object):
         accumulator for the node, with correct shape.
         """
         "*** YOUR CODE HERE ***"
-        self.nodes[node] = node.forward(self.get_inputs(node))  # setting the ouput
-        self.nodeGradients[node] = np.zeros_like(self.get_output(node))
+        self.nodes[node] = self.compute(node)  # setting the ouput
+        # The all-zero accumulator is only allocated once `get_gradient` or
+        # backprop needs it, so that `backprop_and_step` can avoid holding
+        # gradients for the whole graph at once.
 
         self.mynodes.append(node)
+        if self.checkpoint_every and node.get_parents():
+            if self.num_functions % self.checkpoint_every == 0:
+                # A segment's outputs are dropped one checkpoint late, as the
+                # next few nodes are likely to use them
+                self.checkpoints.add(node)
+                for other in self.previous_segment:
+                    self.drop_output(other)
+                self.previous_segment = self.segment
+                self.segment = []
+                self.segment_start = len(self.mynodes)
+            else:
+                self.recompute_from[node] = self.segment_start
+                self.segment.append(node)
+            self.num_functions += 1
+
+    @staticmethod
+    def get_scratch(shape, dtype, index=0):
+        """
+        Returns a temporary array with unspecified contents.
+
+        Scratch arrays are reused by every graph in the current thread, so
+        they only hold values within a single call to `backprop` or `step`.
+        The same array is handed out again for the same shape, dtype and
+        `index`, so callers that need several temporaries of one shape at
+        once ask for distinct indices.
+        """
+        if not hasattr(scratch, 'buffers'):
+            scratch.buffers = {}
+        key = (tuple(shape), np.dtype(dtype))
+        buffers = scratch.buffers.setdefault(key, [])
+        while len(buffers) <= index:
+            buffers.append(np.empty(key[0], key[1]))
+        return buffers[index]
 
     def backprop(self):
         """
@@ -163,23 +405,95 @@ class Graph(object):
         back-propagation should process nodes in the exact opposite of the order
         in which they were added to the graph.
         """
+        "*** YOUR CODE HERE ***"
+        self.sweep()
+
+    def backprop_and_step(self, step_size):
+        """
+        Runs back-propagation and `step` together, in one reverse sweep.
+
+        Each Variable is updated as soon as its gradient is final, i.e. once
+        every node that uses it has passed gradient back. Every other node's
+        gradient is released once that node has passed it on to its parents,
+        and Inputs get no gradient at all. The gradients held at any point are
+        thus those of the sweep's frontier, rather than of the whole graph.
+
+        The result equals calling `backprop` and then `step`, except that
+        afterwards `get_gradient` only works for Variables.
+        """
+        self.sweep(step_size)
+
+    def sweep(self, step_size=None):
+        """
+        The reverse sweep behind `backprop` and, given a `step_size`,
+        `backprop_and_step`.
+        """
         loss_node = self.get_nodes()[-1]
-        assert np.asarray(self.get_output(loss_node)).ndim == 0
+        assert np.asarray(self.output_of(loss_node)).ndim == 0
 
-        "*** YOUR CODE HERE ***"
         self.nodeGradients[loss_node] = 1.0
-        for node in reversed(self.mynodes):
-            nodeInputs = self.get_inputs(node)
-            if node == loss_node:
-                _backwardResults = node.backward(nodeInputs, 1.0)
-            else:
-                _backwardResults = node.backward(nodeInputs, self.get_gradient(node))
-
-        #Backward returns a LIST of gradients.
-        #So next, we will save thos gradients in our list
-            for i in range(0, len(_backwardResults)):
-                parent = node.get_parents()[i]
-                self.nodeGradients[parent] = self.nodeGradients[parent] + _backwardResults[i]
+        fused = step_size is not None
+        if fused:
+            variables = set(self.Variables)
+            # Position of the first node that uses each node. Once the sweep
+            # has passed it, the node's gradient is final.
+            first_use = {}
+            for index, node in enumerate(self.mynodes):
+                for parent in node.get_parents():
+                    first_use.setdefault(parent, index)
+
+        for index in reversed(range(len(self.mynodes))):
+            node = self.mynodes[index]
+            parents = node.get_parents()
+            if not parents:
+                continue
+            gradient = 1.0 if node is loss_node else self.gradient_of(node)
+
+            # A node's first gradient contribution is written straight into a
+            # new accumulator, and later ones go through scratch arrays and are
+            # added in place. In a fused sweep, gradients for Inputs are
+            # written to scratch arrays and discarded.
+            out = []
+            accumulate = []
+            uses = {}
+            for parent in parents:
+                keep = not fused or parent in variables or bool(
+                    parent.get_parents())
+                output = np.asarray(self.output_of(parent))
+                if keep and parent not in self.nodeGradients:
+                    self.nodeGradients[parent] = self.allocate(
+                        output.shape, output.dtype)
+                    out.append(self.nodeGradients[parent])
+                else:
+                    key = (output.shape, output.dtype)
+                    uses[key] = uses.get(key, -1) + 1
+                    out.append(self.get_scratch(key[0], key[1], uses[key]))
+                accumulate.append(keep)
+
+            results = node.backward(self.inputs_of(node), gradient, out=out)
+            for parent, buffer, result, keep in zip(
+                    parents, out, results, accumulate):
+                if not keep:
+                    continue
+                accumulator = self.nodeGradients[parent]
+                if buffer is accumulator:
+                    if result is not accumulator:
+                        np.copyto(accumulator, result)
+                else:
+                    accumulator += result
+
+            if self.checkpoint_every and node is not loss_node:
+                # Only nodes after this one use its output
+                self.drop_output(node)
+            if fused:
+                if node not in variables:
+                    released = self.nodeGradients.pop(node)
+                    if node is not loss_node:
+                        self.free(released)
+                    self.released.add(node)
+                for parent in set(parents):
+                    if parent in variables and first_use[parent] == index:
+                        self.step_variable(parent, step_size)
 
     def step(self, step_size):
         """
@@ -190,9 +504,26 @@ class Graph(object):
         Hint: each Variable has a `.data` attribute
         """
         "*** YOUR CODE HERE ***"
-
         for var in self.Variables:
-            var.data -= self.nodeGradients[var] *step_size
+            self.step_variable(var, step_size)
+
+    def step_variable(self, var, step_size):
+        """Updates a single Variable, as `step` does for all of them"""
+        scale = step_size
+        if np.ndim(step_size) != 0:
+            # One step size per replica, for variables stacked along a
+            # leading axis
+            step_size = np.asarray(step_size)
+            extra_dims = (1,) * (var.data.ndim - step_size.ndim)
+            scale = step_size.reshape(step_size.shape + extra_dims)
+        update = self.get_scratch(var.data.shape, var.data.dtype)
+        np.multiply(self.gradient_of(var), scale, out=update)
+        var.data -= update
+
+def release_buffers(pool, owned):
+    # Called when a Graph is garbage collected
+    pool.put(owned.values())
+    owned.clear()
 
 class DataNode(object):
     """
@@ -257,10 +588,53 @@ class Input(DataNode):
         self.data = data
         graph.add(self)
 
+def unbroadcast(gradient, shape, out=None):
+    """
+    Sums `gradient` over the axes that numpy broadcasting added or stretched
+    to produce it from an input of the given `shape`.
+
+    This lets nodes accept replica-stacked inputs, where K copies of a model's
+    variables are stacked along a leading axis, next to shared inputs that
+    have no such axis.
+
+    A gradient that already has the right shape is returned as is. Otherwise
+    the sum is written to `out`, if given.
+    """
+    gradient = np.asarray(gradient)
+    shape = tuple(shape)
+    if gradient.shape == shape:
+        return gradient
+    extra = gradient.ndim - len(shape)
+    axes = tuple(range(extra)) + tuple(
+        extra + i for i, size in enumerate(shape)
+        if size == 1 and gradient.shape[extra + i] != 1)
+    if out is not None:
+        out = out.reshape((1,) * extra + shape)
+    return np.sum(gradient, axis=axes, keepdims=True, out=out).reshape(shape)
+
+def broadcast_shape(a, b):
+    # The shape numpy broadcasting gives to shapes `a` and `b`. Unlike
+    # np.broadcast_shapes, this allocates no arrays.
+    ndim = max(len(a), len(b))
+    a = (1,) * (ndim - len(a)) + tuple(a)
+    b = (1,) * (ndim - len(b)) + tuple(b)
+    return tuple(y if x == 1 else x for x, y in zip(a, b))
+
+def get_buffer(out, index):
+    # Entry `index` of a backward `out` list, which may itself be None
+    return None if out is None else out[index]
+
 class FunctionNode(object):
     """
     A FunctionNode represents a value that is computed based on other nodes in
     the graph. Each function must implement both a forward and backward pass.
+
+    Both passes take an optional `out` argument, so that the Graph can supply
+    buffers to write results into: for `forward`, one array with the shape of
+    the output, and for `backward`, a list with one array (or None) per input,
+    shaped like that input. The passes may write into these buffers, but may
+    also return views of their inputs or new arrays instead, so callers must
+    use the returned values. Inputs and gradients are never modified.
     """
 
     def __init__(self, graph, *parents):
@@ -271,11 +645,19 @@ class FunctionNode(object):
         return self.parents
 
     @staticmethod
-    def forward(inputs):
+    def output_shape(inputs):
+        """
+        Returns the shape of `forward(inputs)`, or None if it is not known in
+        advance. The Graph uses it to pass `forward` an `out` buffer.
+        """
+        return None
+
+    @staticmethod
+    def forward(inputs, out=None):
         raise NotImplementedError
 
     @staticmethod
-    def backward(inputs, gradient):
+    def backward(inputs, gradient, out=None):
         raise NotImplementedError
 
 class Add(FunctionNode):
@@ -289,12 +671,17 @@ class Add(FunctionNode):
     """
 
     @staticmethod
-    def forward(inputs):
-        return np.add(inputs[0], inputs[1])
+    def output_shape(inputs):
+        return broadcast_shape(np.shape(inputs[0]), np.shape(inputs[1]))
 
     @staticmethod
-    def backward(inputs, gradient):
-        return [np.array(gradient), np.array(gradient)]
+    def forward(inputs, out=None):
+        return np.add(inputs[0], inputs[1], out=out)
+
+    @staticmethod
+    def backward(inputs, gradient, out=None):
+        return [unbroadcast(gradient, np.shape(inputs[0]), get_buffer(out, 0)),
+                unbroadcast(gradient, np.shape(inputs[1]), get_buffer(out, 1))]
 
 class MatrixMultiply(FunctionNode):
     """
@@ -304,21 +691,56 @@ class MatrixMultiply(FunctionNode):
         A represents a matrix of shape (n x m)
         B represents a matrix of shape (m x k)
     Output: a matrix of shape (n x k)
+
+    Either input may also be a stack of matrices, e.g. (K x m x k) for K
+    replicas of a model, in which case every replica is multiplied at once.
     """
 
     @staticmethod
-    def forward(inputs):
-        return np.dot(inputs[0], inputs[1])
+    def output_shape(inputs):
+        A = inputs[0]
+        B = inputs[1]
+        if np.ndim(A) < 2 or np.ndim(B) < 2:
+            return None
+        return broadcast_shape(A.shape[:-2], B.shape[:-2]) + (
+            A.shape[-2], B.shape[-1])
+
+    @staticmethod
+    def forward(inputs, out=None):
+        A = inputs[0]
+        B = inputs[1]
+        if np.ndim(A) < 2 or np.ndim(B) < 2:
+            return np.dot(A, B)
+        return np.matmul(A, B, out=out)
 
     @staticmethod
-    def backward(inputs, gradient):
+    def matmul(A, B, shape, out=None):
+        # A @ B, summed down to `shape`, written to `out` where possible
+        result_shape = broadcast_shape(A.shape[:-2], B.shape[:-2]) + (
+            A.shape[-2], B.shape[-1])
+        if out is not None and result_shape == tuple(shape):
+            return np.matmul(A, B, out=out)
+        return unbroadcast(np.matmul(A, B), shape, out)
+
+    @staticmethod
+    def backward(inputs, gradient, out=None):
         A = inputs[0]
         B = inputs[1]
 
-        gradient_A = np.dot(gradient, np.transpose(B))
-        gradient_B = np.dot(np.transpose(A), gradient)
+        if np.ndim(A) == 0 or np.ndim(B) == 0:
+            # Multiplication by a scalar, which may broadcast over replicas
+            return [unbroadcast(np.multiply(gradient, B), np.shape(A)),
+                    unbroadcast(np.multiply(gradient, A), np.shape(B))]
+        if np.ndim(A) < 2 or np.ndim(B) < 2:
+            return [np.asarray(np.dot(gradient, np.transpose(B))),
+                    np.asarray(np.dot(np.transpose(A), gradient))]
 
-        return [np.array(gradient_A), np.array(gradient_B)]
+        return [
+            MatrixMultiply.matmul(gradient, np.swapaxes(B, -1, -2), A.shape,
+                                  get_buffer(out, 0)),
+            MatrixMultiply.matmul(np.swapaxes(A, -1, -2), gradient, B.shape,
+                                  get_buffer(out, 1)),
+        ]
 
 class MatrixVectorAdd(FunctionNode):
     """
@@ -328,21 +750,39 @@ class MatrixVectorAdd(FunctionNode):
         A represents a matrix of shape (n x m)
         x represents a vector (m)
     Output: a matrix of shape (n x m)
+
+    For K replicas of a model, A may be (K x n x m) and x may be (K x m).
     """
 
     @staticmethod
-    def forward(inputs):
+    def output_shape(inputs):
+        shape_A = np.shape(inputs[0])
+        shape_B = np.shape(inputs[1])
+        if len(shape_B) == len(shape_A) - 1:
+            shape_B = shape_B[:-1] + (1,) + shape_B[-1:]
+        return broadcast_shape(shape_A, shape_B)
+
+    @staticmethod
+    def forward(inputs, out=None):
         A = inputs[0]
         B = inputs[1]
 
-        v = np.array(B)
-        y = np.array
+        if np.ndim(B) == np.ndim(A) - 1:
+            B = np.asarray(B)[..., np.newaxis, :]
 
-        return A + B
+        return np.add(A, B, out=out)
 
     @staticmethod
-    def backward(inputs, gradient):
-        return [gradient, np.sum(gradient,0)]
+    def backward(inputs, gradient, out=None):
+        A = inputs[0]
+        B = inputs[1]
+        if np.ndim(B) == np.ndim(A) - 1:
+            gradient_B = np.sum(gradient, axis=-2)
+        else:
+            # B already has a batch axis, which broadcasting may have stretched
+            gradient_B = gradient
+        return [unbroadcast(gradient, np.shape(A), get_buffer(out, 0)),
+                unbroadcast(gradient_B, np.shape(B), get_buffer(out, 1))]
 
 class ReLU(FunctionNode):
     """
@@ -355,17 +795,63 @@ class ReLU(FunctionNode):
     """
 
     @staticmethod
-    def forward(inputs):
-        return np.maximum(inputs[0], 0)
+    def output_shape(inputs):
+        return np.shape(inputs[0])
 
     @staticmethod
-    def backward(inputs, gradient):
-        x = inputs[0]
-        result = np.where(inputs[0] > 0, 1, 0)
-        temp1 = result * gradient
-        temp2 = np.array(temp1)
-        temp3 = [temp2]
-        return temp3
+    def forward(inputs, out=None):
+        return np.maximum(inputs[0], 0, out=out)
+
+    @staticmethod
+    def backward(inputs, gradient, out=None):
+        return [np.multiply(gradient, inputs[0] > 0, out=get_buffer(out, 0))]
+
+class Where(FunctionNode):
+    """
+    Picks each entry from one of two inputs, according to a mask.
+
+    Inputs: [mask, x, y]
+        mask is a matrix of zeros and ones that broadcasts against x, e.g. of
+            shape (batch_size x 1) to pick whole rows
+        x represents a matrix
+        y must have the same shape as x
+    Output: a matrix with the entries of x where the mask is 1, and those of
+        y where it is 0
+
+    The gradient with respect to the mask is that of mask * x + (1 - mask) * y.
+    For example, a recurrent network can keep the hidden state of words that
+    have already ended by passing the new state as x and the old one as y.
+    """
+
+    @staticmethod
+    def output_shape(inputs):
+        return broadcast_shape(np.shape(inputs[0]), broadcast_shape(
+            np.shape(inputs[1]), np.shape(inputs[2])))
+
+    @staticmethod
+    def forward(inputs, out=None):
+        mask, x, y = inputs
+        if out is None:
+            return np.where(mask != 0, x, y)
+        np.copyto(out, y)
+        np.copyto(out, x, where=(mask != 0))
+        return out
+
+    @staticmethod
+    def backward(inputs, gradient, out=None):
+        mask, x, y = inputs
+        shape = np.shape(gradient)
+        gradient_x = np.multiply(
+            gradient, mask != 0,
+            out=get_buffer(out, 1) if np.shape(x) == shape else None)
+        gradient_y = np.subtract(
+            gradient, gradient_x,
+            out=get_buffer(out, 2) if np.shape(y) == shape else None)
+        gradient_mask = np.subtract(x, y)
+        gradient_mask *= gradient
+        return [unbroadcast(gradient_mask, np.shape(mask), get_buffer(out, 0)),
+                unbroadcast(gradient_x, np.shape(x), get_buffer(out, 1)),
+                unbroadcast(gradient_y, np.shape(y), get_buffer(out, 2))]
 
 class SquareLoss(FunctionNode):
     """
@@ -377,19 +863,41 @@ class SquareLoss(FunctionNode):
     This node first computes 0.5 * (a[i,j] - b[i,j])**2 at all positions (i,j)
     in the inputs, which creates a (batch_size x dim) matrix. It then calculates
     and returns the mean of all elements in this matrix.
+
+    If a is a stack of K replicas' predictions (K x batch_size x dim), b may be
+    shared between them, and the output is the sum of the K replicas' losses.
+    See `SquareLoss.replica_losses` for the individual losses.
     """
 
     @staticmethod
-    def forward(inputs):
-        diff = np.subtract(inputs[0], inputs[1])
-        exp = np.power(diff, 2)
-        result = exp * 0.5
-        return np.mean(result)
+    def replica_losses(inputs, out=None):
+        diff = np.subtract(inputs[0], inputs[1], out=out)
+        diff *= diff
+        if np.ndim(diff) < 2:
+            return np.mean(diff) * 0.5
+        return np.mean(diff, axis=(-2, -1)) * 0.5
 
     @staticmethod
-    def backward(inputs, gradient):
-        diff = np.subtract(inputs[0], inputs[1])
-        return [diff * gradient * (1.0/(inputs[0].size)), gradient * (-1.0)* diff * (1.0/(inputs[0].size))]
+    def forward(inputs, out=None):
+        return np.sum(SquareLoss.replica_losses(inputs))
+
+    @staticmethod
+    def backward(inputs, gradient, out=None):
+        shape_a = np.shape(inputs[0])
+        shape_b = np.shape(inputs[1])
+        out_a = get_buffer(out, 0)
+        out_b = get_buffer(out, 1)
+        count = np.prod(shape_a[-2:])
+
+        same_shape = broadcast_shape(shape_a, shape_b) == shape_a
+        diff = np.subtract(inputs[0], inputs[1],
+                           out=out_a if same_shape else None)
+        diff *= gradient * (1.0/count)
+        gradient_a = unbroadcast(diff, shape_a, out_a)
+        gradient_b = unbroadcast(diff, shape_b, out_b)
+        gradient_b = np.negative(
+            gradient_b, out=out_b if gradient_b is diff else gradient_b)
+        return [gradient_a, gradient_b]
 
 class SoftmaxLoss(FunctionNode):
     """
@@ -406,31 +914,55 @@ class SoftmaxLoss(FunctionNode):
             sum of values along each row should be 1.
     Output: a number
 
+    As with SquareLoss, the logits may be stacked for K replicas of a model
+    (K x batch_size x num_classes), and the output is then the sum of the K
+    replicas' losses.
+
     We have provided the complete implementation for your convenience.
     """
     @staticmethod
-    def softmax(input):
-        exp = np.exp(input - np.max(input, axis=1, keepdims=True))
-        return exp / np.sum(exp, axis=1, keepdims=True)
+    def softmax(input, out=None):
+        exp = np.subtract(input, np.max(input, axis=-1, keepdims=True), out=out)
+        np.exp(exp, out=exp)
+        exp /= np.sum(exp, axis=-1, keepdims=True)
+        return exp
 
     @staticmethod
-    def forward(inputs):
-        softmax = SoftmaxLoss.softmax(inputs[0])
+    def log_softmax(input, out=None):
+        shifted = np.subtract(
+            input, np.max(input, axis=-1, keepdims=True), out=out)
+        shifted -= np.log(np.sum(np.exp(shifted), axis=-1, keepdims=True))
+        return shifted
+
+    @staticmethod
+    def forward(inputs, out=None):
+        log_softmax = SoftmaxLoss.log_softmax(inputs[0])
         labels = inputs[1]
         assert np.all(labels >= 0), \
             "Labels input to SoftmaxLoss must be non-negative. (Did you pass the inputs in the right order?)"
-        assert np.allclose(np.sum(labels, axis=1), np.ones(labels.shape[0])), \
+        assert np.allclose(np.sum(labels, axis=-1), 1), \
             "Labels input to SoftmaxLoss do not sum to 1 along each row. (Did you pass the inputs in the right order?)"
 
-        return np.mean(-np.sum(labels * np.log(softmax), axis=1))
+        log_softmax *= labels
+        return np.sum(np.mean(-np.sum(log_softmax, axis=-1), axis=-1))
 
     @staticmethod
-    def backward(inputs, gradient):
-        softmax = SoftmaxLoss.softmax(inputs[0])
-        return [
-            gradient * (softmax - inputs[1]) / inputs[0].shape[0],
-            gradient * (-np.log(softmax)) / inputs[0].shape[0]
-        ]
+    def backward(inputs, gradient, out=None):
+        logits = inputs[0]
+        labels = inputs[1]
+        out_logits = get_buffer(out, 0)
+        out_labels = get_buffer(out, 1)
+        scale = gradient / logits.shape[-2]
+
+        same_shape = np.shape(labels) == np.shape(logits)
+        log_softmax = SoftmaxLoss.log_softmax(
+            logits, out=out_labels if same_shape else None)
+        softmax = np.exp(log_softmax, out=out_logits)
+        softmax -= labels
+        softmax *= scale
+        log_softmax *= -scale
+        return [unbroadcast(softmax, np.shape(logits)),
+                unbroadcast(log_softmax, np.shape(labels), out_labels)]
 
 if __name__ == '__main__':
     main()
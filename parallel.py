@@ -0,0 +1,336 @@
+import contextlib
+import copy
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+# BLAS thread pools are per process, so parallel workers each get a single
+# thread rather than oversubscribing the cores they already split between them
+BLAS_THREAD_VARIABLES = [
+    "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+
+def shared_array(shape, value=None):
+    """Allocates a float64 array in shared memory
+
+    Args:
+        shape (tuple): Shape of the array
+        value (np.array): Optional initial contents
+
+    Returns:
+        tuple: (RawArray, np.array view of it). Only the RawArray can be
+            handed to a new process
+    """
+    raw = multiprocessing.RawArray("d", int(np.prod(shape)))
+    array = as_array(raw, shape)
+    if value is not None:
+        array[...] = value
+    return raw, array
+
+def as_array(raw, shape):
+    return np.frombuffer(raw, dtype=np.float64).reshape(shape)
+
+def share_variables(variables):
+    """Moves the data of each nn.Variable into shared memory, in place
+
+    Returns:
+        list: The RawArray now backing each variable
+    """
+    raws = []
+    for variable in variables:
+        raw, variable.data = shared_array(variable.data.shape, variable.data)
+        raws.append(raw)
+    return raws
+
+def attach_variables(variables, raws):
+    """Points each nn.Variable at its shared buffer from `share_variables`"""
+    for variable, raw in zip(variables, raws):
+        variable.data = as_array(raw, variable.data.shape)
+
+@contextlib.contextmanager
+def single_threaded_blas():
+    """Makes processes started inside the block use one BLAS thread each"""
+    old_values = {name: os.environ.get(name) for name in BLAS_THREAD_VARIABLES}
+    os.environ.update({name: "1" for name in BLAS_THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for name, value in old_values.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+def run_data_parallel_worker(model, params, grads, inputs, labels, connection):
+    """Computes gradients for shards of the batches in `inputs` and `labels`
+
+    Each request is a (start, stop, weight) triple. The worker backprops
+    through rows start:stop, writes `weight` times the gradient of every
+    variable to `grads`, and replies with the shard's loss. None stops it.
+    """
+    variables = model.get_variables()
+    attach_variables(variables, params)
+    grads = [as_array(raw, v.data.shape) for raw, v in zip(grads, variables)]
+    x_all = as_array(*inputs)
+    y_all = as_array(*labels)
+
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        start, stop, weight = request
+        graph = model.run(x_all[start:stop], y_all[start:stop])
+        graph.backprop()
+        for grad, variable in zip(grads, variables):
+            np.multiply(graph.get_gradient(variable), weight, out=grad)
+        connection.send(float(graph.get_output(graph.get_nodes()[-1])))
+    connection.close()
+
+class DataParallelTrainer(object):
+    def __init__(self, model, num_workers, capacity, x_shape, y_shape):
+        """Synchronous data-parallel SGD over shared-memory Variables
+
+        The model's variables are moved into shared memory, and each of
+        `num_workers` processes holds a replica of the model that reads them.
+        Every batch is copied into a shared input buffer and split into one
+        contiguous shard per worker. Workers backprop through their shard, and
+        the shard gradients are averaged, weighted by shard size, before a
+        single step is applied to the shared variables. Since the losses are
+        means over the batch, this step equals the single-process one.
+
+        Batches with more than `capacity` rows are processed in chunks, and
+        the chunk gradients are accumulated before the step.
+
+        Args:
+            model (Model): Model whose `run(x, y)` returns a graph with a loss
+            num_workers (int): Number of worker processes
+            capacity (int): Number of rows in the shared input buffers
+            x_shape (tuple): Shape of one row of inputs
+            y_shape (tuple): Shape of one row of labels
+        """
+        self.model = model
+        self.capacity = capacity
+        self.variables = model.get_variables()
+        params = share_variables(self.variables)
+
+        inputs = (capacity,) + tuple(x_shape)
+        labels = (capacity,) + tuple(y_shape)
+        raw_inputs, self.inputs = shared_array(inputs)
+        raw_labels, self.labels = shared_array(labels)
+
+        # Workers only need the architecture; the data stays in this process
+        replica = copy.copy(model)
+        replica.get_data_and_monitor = None
+
+        context = multiprocessing.get_context("spawn")
+        self.grads = []
+        self.connections = []
+        self.workers = []
+        with single_threaded_blas():
+            for _ in range(num_workers):
+                raws, arrays = zip(*[
+                    shared_array(v.data.shape) for v in self.variables])
+                parent, child = context.Pipe()
+                worker = context.Process(
+                    target=run_data_parallel_worker,
+                    args=(replica, params, raws, (raw_inputs, inputs),
+                          (raw_labels, labels), child))
+                worker.daemon = True
+                worker.start()
+                child.close()
+                self.grads.append(arrays)
+                self.connections.append(parent)
+                self.workers.append(worker)
+
+    def gradients(self, x, y):
+        """Returns the gradient of the mean loss over the batch (x, y)
+
+        Returns:
+            tuple: (list of gradient arrays in `model.get_variables()` order,
+                mean loss over the batch)
+        """
+        totals = [np.zeros_like(v.data) for v in self.variables]
+        loss = 0.0
+        for offset in range(0, len(x), self.capacity):
+            chunk = slice(offset, offset + self.capacity)
+            size = len(x[chunk])
+            self.inputs[:size] = x[chunk]
+            self.labels[:size] = y[chunk]
+
+            bounds = np.linspace(0, size, len(self.workers) + 1).astype(int)
+            active = []
+            for connection, grads, start, stop in zip(
+                    self.connections, self.grads, bounds[:-1], bounds[1:]):
+                if stop > start:
+                    weight = 1.0 * (stop - start) / len(x)
+                    connection.send((int(start), int(stop), weight))
+                    active.append((connection, weight, grads))
+
+            for connection, weight, grads in active:
+                loss += weight * connection.recv()
+                for total, grad in zip(totals, grads):
+                    total += grad
+        return totals, loss
+
+    def step(self, x, y, learning_rate):
+        grads, loss = self.gradients(x, y)
+        for variable, grad in zip(self.variables, grads):
+            variable.data -= learning_rate * grad
+        return loss
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+
+def train_data_parallel(model, num_workers, max_steps=None,
+                        **monitor_options):
+    """Trains `model` like Model.train, splitting every batch over processes
+
+    Workers are started on the first batch, whose size sets the capacity of
+    the shared input buffers. `max_steps` is passed on to the model's
+    get_data_and_monitor, which then stops after that many batches and runs
+    its final evaluation. Returns the number of steps taken.
+    """
+    if max_steps is not None:
+        monitor_options['max_steps'] = max_steps
+    trainer = None
+    steps = 0
+    try:
+        for x, y in model.get_data_and_monitor(model, **monitor_options):
+            if trainer is None:
+                trainer = DataParallelTrainer(
+                    model, num_workers, len(x), x.shape[1:], y.shape[1:])
+            trainer.step(x, y, model.get_learning_rate(steps))
+            steps += 1
+    finally:
+        if trainer is not None:
+            trainer.close()
+    return steps
+
+def sparse_step(graph, variables, learning_rate):
+    """Like Graph.step, but only writes the rows of each matrix that changed
+
+    One-hot inputs only give gradient to the rows of the characters they
+    contain, so skipping zero rows keeps concurrent writers off each other's
+    cache lines.
+    """
+    for variable in variables:
+        grad = graph.get_gradient(variable)
+        if grad.ndim == 2:
+            rows = np.flatnonzero(np.any(grad, axis=1))
+            if len(rows) < len(grad):
+                variable.data[rows] -= learning_rate * grad[rows]
+                continue
+        variable.data -= learning_rate * grad
+
+def run_hogwild_worker(model, params, worker_id, steps, stop_event,
+                       iterations, batch_size, seed):
+    """Runs lock-free SGD steps on the shared variables of `model`
+
+    The worker draws its own batches, and records how many steps it has
+    taken in `steps[worker_id]`. Learning rates come from the model's
+    schedule, if any, at the number of steps taken by all workers together.
+    """
+    import backend
+
+    variables = model.get_variables()
+    attach_variables(variables, params)
+    steps = np.frombuffer(steps, dtype=np.int64)
+    data = backend.LanguageIDData()
+    random_state = np.random.RandomState(seed)
+
+    for step in range(iterations):
+        if stop_event.is_set():
+            break
+        xs, y = data.sample(batch_size, random_state)
+        graph = model.run(xs, y)
+        graph.backprop()
+        sparse_step(graph, variables, model.get_learning_rate(int(steps.sum())))
+        steps[worker_id] = step + 1
+
+def train_hogwild(model, num_workers, iterations=15000, batch_size=16,
+                  seed=None, log_interval=1000, stop_criterion=None,
+                  max_steps=None):
+    """Trains a LanguageIDModel with Hogwild-style SGD
+
+    `num_workers` processes update the model's shared-memory variables
+    without any locking, each drawing batches from its own sampler over the
+    lang_id.npz buckets. The `iterations` steps are split between the
+    workers. Meanwhile this process reports dev accuracy every
+    `log_interval` steps, and consults `stop_criterion` on the
+    'dev_accuracy' stat as get_data_and_monitor_lang_id would. If given,
+    `max_steps` caps the total number of steps like `iterations` does.
+
+    Returns:
+        dict: Stats with the final 'dev_accuracy', the number of 'steps'
+            taken, and the wall-clock 'seconds' spent training
+    """
+    import backend
+
+    if max_steps is not None:
+        iterations = min(iterations, max_steps)
+    stats = {}
+    backend.set_stats(model, stats)
+    if stop_criterion is not None:
+        stop_criterion.start()
+    data = backend.LanguageIDData()
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+
+    variables = model.get_variables()
+    params = share_variables(variables)
+    replica = copy.copy(model)
+    replica.get_data_and_monitor = None
+
+    context = multiprocessing.get_context("spawn")
+    raw_steps = multiprocessing.RawArray("q", num_workers)
+    steps = np.frombuffer(raw_steps, dtype=np.int64)
+    stop_event = context.Event()
+    shares = np.diff(np.linspace(0, iterations, num_workers + 1).astype(int))
+    workers = []
+    with single_threaded_blas():
+        for worker_id, share in enumerate(shares):
+            worker = context.Process(
+                target=run_hogwild_worker,
+                args=(replica, params, worker_id, raw_steps, stop_event,
+                      int(share), batch_size, seed + worker_id))
+            worker.daemon = True
+            workers.append(worker)
+        start = time.time()
+        for worker in workers:
+            worker.start()
+
+    try:
+        next_log = log_interval
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(0.05)
+            if (next_log <= steps.sum() < iterations
+                    and not stop_event.is_set()):
+                next_log += log_interval
+                stats['dev_accuracy'] = data.accuracy(model)
+                backend.count_evaluation(stats)
+                print("iteration {:,} accuracy {:.1%}".format(
+                    int(steps.sum()), stats['dev_accuracy']))
+                if backend.should_stop(stop_criterion, stats):
+                    stop_event.set()
+    finally:
+        stop_event.set()
+        for worker in workers:
+            worker.join()
+
+    stats['seconds'] = time.time() - start
+    stats['steps'] = int(steps.sum())
+    stats['dev_accuracy'] = data.accuracy(model)
+    backend.count_evaluation(stats)
+    print("iteration {:,} accuracy {:.1%}".format(
+        stats['steps'], stats['dev_accuracy']))
+    return stats
@@ -2,9 +2,13 @@ import numpy as np
 
 import backend
 
+# Datasets with more points than this train with the vectorized batch rule by
+# default, since sequential updates over them take minutes
+large_dataset_points = 10000
+
 class Perceptron(object):
 
-    def __init__(self, dimensions):
+    def __init__(self, dimensions, get_data_and_monitor=None):
         """
         Initialize a new Perceptron instance.
 
@@ -12,8 +16,14 @@ class Perceptron(object):
         class (+1) or not (-1). `dimensions` is the dimensionality of the data.
         For example, dimensions=2 would mean that the perceptron must classify
         2D points.
+
+        `get_data_and_monitor` is the data source to train on, e.g.
+        backend.make_get_data_and_monitor_perceptron(points=10**6). By default,
+        it is a fresh dataset of 500 points.
         """
-        self.get_data_and_monitor = backend.make_get_data_and_monitor_perceptron()
+        if get_data_and_monitor is None:
+            get_data_and_monitor = backend.make_get_data_and_monitor_perceptron()
+        self.get_data_and_monitor = get_data_and_monitor
 
         "*** YOUR CODE HERE ***"
         self.weightVector = np.zeros(dimensions) # one array with x dimensions?
@@ -41,6 +51,16 @@ class Perceptron(object):
         else:
             return -1 
 
+    def predict_many(self, xs):
+        """
+        Calculates the predicted classes for a batch of data points.
+
+        xs is an (N x D) numpy array
+
+        Returns: a numpy array with N entries, each 1 or -1
+        """
+        return np.where(np.dot(xs, self.weightVector) >= 0, 1, -1)
+
     def update(self, x, y):
         """
         Update the weights of the perceptron based on a single example.
@@ -58,10 +78,16 @@ class Perceptron(object):
             self.weightVector = self.weightVector+ x*y
             return True  
 
-    def train(self):
+    def train(self, vectorized=None, ordered=None):
         """
         Train the perceptron until convergence.
 
+        If `vectorized` is True, each epoch receives the whole dataset at once
+        and finds misclassified points with matrix products instead of calling
+        `update` per point (see `update_ordered` and `update_bulk`). By
+        default, only datasets of more than `large_dataset_points` points are
+        trained this way, with the bulk rule unless `ordered` is True.
+
         To iterate through all of the data points once (a single epoch), you can
         do:
             for x, y in self.get_data_and_monitor(self):
@@ -72,6 +98,13 @@ class Perceptron(object):
         graphics in between yielding data points.
         """
         "*** YOUR CODE HERE ***"
+        if vectorized is None:
+            points = getattr(self.get_data_and_monitor, 'points', 0)
+            vectorized = points > large_dataset_points
+        if vectorized:
+            self.train_vectorized(ordered)
+            return
+
         corrections = 1
         while corrections > 0:   
             corrections = 0
@@ -79,4 +112,69 @@ class Perceptron(object):
                 boolUpdate = self.update(x,y)
                 if boolUpdate:
                     corrections += 1  
-        return 
+        return
+
+    def train_vectorized(self, ordered=None, chunk_size=4096):
+        """
+        Train the perceptron until convergence, one whole-dataset epoch at a
+        time.
+
+        With `ordered`, the weights are those that per-point training finds.
+        Otherwise every epoch applies the batch rule, which takes seconds on
+        millions of points. By default, datasets of up to
+        `large_dataset_points` points are trained in order.
+
+        Training stops as soon as an epoch makes no corrections.
+        """
+        converged = False
+        while not converged:
+            for xs, ys in self.get_data_and_monitor(self, batch=True):
+                if ordered is None:
+                    ordered = len(xs) <= large_dataset_points
+                if ordered:
+                    corrections = self.update_ordered(xs, ys, chunk_size)
+                else:
+                    corrections = self.update_bulk(xs, ys)
+                converged = corrections == 0
+
+    def update_ordered(self, xs, ys, chunk_size=4096):
+        """
+        Runs one epoch of perceptron updates over a batch of examples, in
+        order. The result is identical to calling `update` on every example,
+        but points are scored a window at a time, and scoring restarts after
+        the first mistake in the window. The window size adapts to the gap
+        between mistakes, up to `chunk_size`.
+
+        Returns: the number of corrections made
+        """
+        positive = ys > 0
+        corrections = 0
+        start = 0
+        window = chunk_size
+        while start < len(xs):
+            end = min(start + window, len(xs))
+            # A point is misclassified when its predicted sign differs
+            wrong = (np.dot(xs[start:end], self.weightVector) >= 0) != \
+                positive[start:end]
+            first = np.argmax(wrong)
+            if not wrong[first]:
+                start = end
+                window = min(2 * window, chunk_size)
+            else:
+                i = start + first
+                self.weightVector = self.weightVector + xs[i] * ys[i]
+                corrections += 1
+                start = i + 1
+                window = min(max(2 * (first + 1), 16), chunk_size)
+        return corrections
+
+    def update_bulk(self, xs, ys):
+        """
+        Updates the weights with every misclassified example at once (the
+        batch perceptron rule), which also converges on separable data.
+
+        Returns: the number of corrections made
+        """
+        wrong = self.predict_many(xs) != ys
+        self.weightVector = self.weightVector + np.dot(ys[wrong], xs[wrong])
+        return int(np.count_nonzero(wrong))
@@ -0,0 +1,114 @@
+import math
+
+class Schedule(object):
+    """
+    A learning-rate schedule. This base class keeps the rate constant.
+
+    A model trains with a schedule by setting its `schedule` attribute, e.g.
+        model.schedule = LinearWarmup(500, CosineSchedule(20000))
+    On every step, Model.train asks the schedule for the rate to use, given the
+    model's base `learning_rate`, the number of steps taken so far and the
+    model's current backend stats.
+    """
+
+    def factor(self, step, stats):
+        """Returns the multiple of the base learning rate to use at `step`"""
+        return 1.0
+
+    def rate(self, learning_rate, step, stats):
+        return learning_rate * self.factor(step, stats)
+
+class StepSchedule(Schedule):
+    def __init__(self, step_size, gamma=0.1):
+        """Multiplies the learning rate by `gamma` every `step_size` steps"""
+        self.step_size = step_size
+        self.gamma = gamma
+
+    def factor(self, step, stats):
+        return self.gamma ** (step // self.step_size)
+
+class ExponentialSchedule(Schedule):
+    def __init__(self, gamma):
+        """Multiplies the learning rate by `gamma` after every step"""
+        self.gamma = gamma
+
+    def factor(self, step, stats):
+        return self.gamma ** step
+
+class CosineSchedule(Schedule):
+    def __init__(self, total_steps, min_factor=0.0):
+        """Anneals the learning rate along half a cosine over `total_steps`
+
+        The rate falls from the base rate to `min_factor` times the base rate,
+        and stays there afterwards.
+        """
+        self.total_steps = total_steps
+        self.min_factor = min_factor
+
+    def factor(self, step, stats):
+        progress = min(step, self.total_steps) / float(self.total_steps)
+        cosine = 0.5 * (1.0 + math.cos(math.pi * progress))
+        return self.min_factor + (1.0 - self.min_factor) * cosine
+
+class LinearWarmup(Schedule):
+    def __init__(self, warmup_steps, schedule=None):
+        """Ramps the learning rate up linearly over `warmup_steps` steps
+
+        Afterwards, `schedule` takes over, counting steps from the end of the
+        warmup. Without a schedule, the base rate is kept.
+        """
+        self.warmup_steps = warmup_steps
+        self.schedule = schedule if schedule is not None else Schedule()
+
+    def factor(self, step, stats):
+        if step < self.warmup_steps:
+            return (step + 1) / float(self.warmup_steps)
+        return self.schedule.factor(step - self.warmup_steps, stats)
+
+class ReduceOnPlateau(Schedule):
+    def __init__(self, metric, mode="min", factor=0.5, patience=5,
+                 min_delta=0.0, min_factor=0.0):
+        """Cuts the learning rate when a backend stat stops improving
+
+        The monitors update stats periodically, counting each update in the
+        'evaluations' stat, so a metric that repeats exactly still counts as
+        a new evaluation. After `patience` evaluations in a row without
+        an improvement of more than `min_delta`, the rate is multiplied by
+        `factor`, but never brought below `min_factor` times the base rate.
+
+        Args:
+            metric (str): Key in the stats dict, e.g. "loss" or "dev_accuracy"
+            mode (str): "min" if lower values of the metric are better,
+                "max" if higher values are better
+        """
+        assert mode in ("min", "max"), "mode must be 'min' or 'max'"
+        self.metric = metric
+        self.mode = mode
+        self.reduction = factor
+        self.patience = patience
+        self.min_delta = min_delta
+        self.min_factor = min_factor
+        self.current = 1.0
+        self.best = None
+        self.last_evaluation = None
+        self.evaluations_without_improvement = 0
+
+    def factor(self, step, stats):
+        value = stats.get(self.metric)
+        evaluation = stats.get('evaluations')
+        if value is None or evaluation == self.last_evaluation:
+            return self.current
+        self.last_evaluation = evaluation
+
+        if self.best is None or (
+                self.best - value if self.mode == "min"
+                else value - self.best) > self.min_delta:
+            self.best = value
+            self.evaluations_without_improvement = 0
+        else:
+            self.evaluations_without_improvement += 1
+            if self.evaluations_without_improvement >= self.patience:
+                self.current = max(
+                    self.current * self.reduction, self.min_factor)
+                self.evaluations_without_improvement = 0
+        return self.current
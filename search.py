@@ -0,0 +1,267 @@
+# Hyperparameter search over the models in models.py
+
+import contextlib
+import inspect
+import itertools
+import math
+import multiprocessing
+import optparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+# The stat used to score each model, and whether lower ("min") or higher
+# ("max") values are better
+METRICS = {
+    'RegressionModel': ('loss', 'min'),
+    'OddRegressionModel': ('loss', 'min'),
+    'DigitClassificationModel': ('dev_accuracy', 'max'),
+    'DeepQModel': ('mean_reward', 'max'),
+    'LanguageIDModel': ('dev_accuracy', 'max'),
+}
+
+HYPERPARAMETERS = ['learning_rate', 'hidden_size', 'num_layers']
+
+def run_trial(trial):
+    """
+    Trains one configuration in a worker process, returning a result row.
+
+    `trial` is a (model_name, config, max_steps, target, patience, seed) tuple.
+    Training stops early once the metric reaches `target`, or after `patience`
+    evaluations without improvement, so poor trials give their worker back.
+    """
+    import backend, models
+    model_name, config, max_steps, target, patience, seed = trial
+    metric, mode = METRICS[model_name]
+    backend.use_graphics = False
+
+    np.random.seed(seed)
+    random.seed(seed)
+    stop_criterion = backend.StopCriterion(
+        metric, target=target, mode=mode, patience=patience)
+    start = time.time()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        model = getattr(models, model_name)(**config)
+        steps = model.train(max_steps=max_steps, stop_criterion=stop_criterion)
+    stats = backend.get_stats(model) or {}
+
+    result = dict(config)
+    result['score'] = stats.get(metric)
+    result['steps'] = steps
+    result['seconds'] = time.time() - start
+    result['reached_target'] = stop_criterion.reached_target
+    result['stopped'] = stop_criterion.reason or ''
+    return result
+
+def rank_key(mode):
+    """
+    Orders results best first: trials that reached the target come first,
+    fastest first, followed by the rest by score.
+    """
+    def key(result):
+        score = result['score']
+        if score is None or math.isnan(score):
+            score = float('inf')
+        elif mode == 'max':
+            score = -score
+        if result['reached_target']:
+            return (0, result['seconds'], score)
+        return (1, score, result['seconds'])
+    return key
+
+def grid_configs(space):
+    names = sorted(space)
+    for values in itertools.product(*[space[name] for name in names]):
+        yield dict(zip(names, values))
+
+def random_configs(space, num_trials, random_state):
+    """Samples up to `num_trials` distinct configurations from the grid"""
+    configs = list(grid_configs(space))
+    order = random_state.permutation(len(configs))
+    return [configs[i] for i in order[:num_trials]]
+
+def run_trials(pool, model_name, configs, max_steps, options):
+    # Every configuration trains from the same seed, so that they are compared
+    # on the same initialization and data
+    trials = [(model_name, config, max_steps, options.target,
+               options.patience, options.seed)
+              for config in configs]
+    results = []
+    for result in pool.imap_unordered(run_trial, trials):
+        print_row(result)
+        results.append(result)
+    return results
+
+def successive_halving(pool, model_name, configs, options):
+    """
+    Trains every configuration for a small budget of steps, keeps the best
+    1/eta of them, and repeats with eta times the budget until one
+    configuration is left or the budget reaches `options.max_steps`.
+    """
+    configs = list(configs)
+    metric, mode = METRICS[model_name]
+    budget = options.min_steps
+    results = []
+    while True:
+        print("\n{} configurations with a budget of {:,} steps".format(
+            len(configs), budget))
+        rung = run_trials(pool, model_name, configs, budget, options)
+        for result in rung:
+            result['budget'] = budget
+        results.extend(rung)
+        if len(configs) <= 1 or budget >= options.max_steps:
+            return results
+        rung.sort(key=rank_key(mode))
+        keep = max(1, int(math.ceil(len(rung) / float(options.eta))))
+        configs = [{name: result[name] for name in configs[0]}
+                   for result in rung[:keep]]
+        budget = min(budget * options.eta, options.max_steps)
+
+COLUMNS = HYPERPARAMETERS + ['score', 'steps', 'seconds', 'stopped']
+
+def format_value(value):
+    if isinstance(value, float):
+        return '{:.6g}'.format(value)
+    return str(value)
+
+def print_row(result):
+    print('  '.join('{}={}'.format(name, format_value(result.get(name)))
+                    for name in COLUMNS if name in result))
+
+def write_table(results, path, columns):
+    with open(path, 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for result in results:
+            f.write('\t'.join(format_value(result.get(name, ''))
+                              for name in columns) + '\n')
+
+def parse_values(text, type):
+    return [type(value) for value in text.split(',')]
+
+def parse_options(argv):
+    parser = optparse.OptionParser(
+        usage = '%prog [options] MODEL',
+        description = 'Search hyperparameters of a model in models.py: {}'.format(
+            ', '.join(sorted(METRICS))))
+    parser.add_option('--strategy',
+                        dest = 'strategy',
+                        choices = ['grid', 'random', 'halving'],
+                        default = 'grid',
+                        help = 'grid, random or halving (successive halving) (default %default)')
+    parser.add_option('--learning-rate',
+                        dest = 'learning_rate',
+                        default = None,
+                        help = 'Comma-separated learning rates to try')
+    parser.add_option('--hidden-size',
+                        dest = 'hidden_size',
+                        default = None,
+                        help = 'Comma-separated hidden sizes to try')
+    parser.add_option('--num-layers',
+                        dest = 'num_layers',
+                        default = None,
+                        help = 'Comma-separated numbers of layers to try')
+    parser.add_option('--trials',
+                        dest = 'trials',
+                        type = 'int',
+                        default = 16,
+                        help = 'Number of configurations to sample for random and halving (default %default)')
+    parser.add_option('--max-steps',
+                        dest = 'max_steps',
+                        type = 'int',
+                        default = None,
+                        help = 'Most training steps per trial (default: a full training run)')
+    parser.add_option('--min-steps',
+                        dest = 'min_steps',
+                        type = 'int',
+                        default = 500,
+                        help = 'Steps per trial in the first round of halving (default %default)')
+    parser.add_option('--eta',
+                        dest = 'eta',
+                        type = 'int',
+                        default = 3,
+                        help = 'Keep 1/eta of the trials per round of halving (default %default)')
+    parser.add_option('--target',
+                        dest = 'target',
+                        type = 'float',
+                        default = None,
+                        help = 'Stop a trial once its metric reaches this value; trials are then ranked by time')
+    parser.add_option('--patience',
+                        dest = 'patience',
+                        type = 'int',
+                        default = None,
+                        help = 'Stop a trial after this many evaluations without improvement (default: never)')
+    parser.add_option('--workers',
+                        dest = 'workers',
+                        type = 'int',
+                        default = multiprocessing.cpu_count(),
+                        help = 'Number of worker processes (default %default)')
+    parser.add_option('--seed',
+                        dest = 'seed',
+                        type = 'int',
+                        default = 0,
+                        help = 'Seed for sampling configurations and training (default %default)')
+    parser.add_option('--output', '-o',
+                        dest = 'output',
+                        default = 'search_results.tsv',
+                        help = 'Where to write the results table (default %default)')
+    (options, args) = parser.parse_args(argv[1:])
+    if len(args) != 1 or args[0] not in METRICS:
+        parser.error('expected one model name: {}'.format(', '.join(sorted(METRICS))))
+    if options.strategy == 'halving' and options.max_steps is None:
+        parser.error('--strategy halving requires --max-steps')
+    return options, args[0]
+
+def main():
+    options, model_name = parse_options(sys.argv)
+    import models
+
+    # Default to each model's own value for anything not being searched
+    parameters = inspect.signature(getattr(models, model_name)).parameters
+    space = {}
+    for name, type in zip(HYPERPARAMETERS, [float, int, int]):
+        text = getattr(options, name)
+        space[name] = (parse_values(text, type) if text
+                       else [parameters[name].default])
+
+    if options.strategy == 'grid':
+        configs = list(grid_configs(space))
+    else:
+        configs = random_configs(
+            space, options.trials, np.random.RandomState(options.seed))
+
+    metric, mode = METRICS[model_name]
+    print("Searching {} configurations of {}, scored by {} ({})".format(
+        len(configs), model_name, metric, mode))
+
+    start = time.time()
+    context = multiprocessing.get_context('spawn')
+    pool = context.Pool(options.workers)
+    try:
+        if options.strategy == 'halving':
+            results = successive_halving(pool, model_name, configs, options)
+            columns = COLUMNS + ['budget']
+        else:
+            results = run_trials(
+                pool, model_name, configs, options.max_steps, options)
+            columns = COLUMNS
+    finally:
+        pool.terminate()
+
+    key = rank_key(mode)
+    if options.strategy == 'halving':
+        # Only the last round trained its configurations for the full budget
+        results.sort(key=lambda result: (-result['budget'], key(result)))
+    else:
+        results.sort(key=key)
+    write_table(results, options.output, columns)
+    print("\nSearch took {:.1f}s; results written to {}".format(
+        time.time() - start, options.output))
+    print("Best configuration:")
+    print_row(results[0])
+
+
+if __name__ == '__main__':
+    main()